@@ -1,16 +1,51 @@
+import hashlib
 import os
+import time
+from datetime import datetime
+
+import click
+
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, abort,
+    jsonify, make_response, get_flashed_messages, stream_with_context,
+    url_for, Response, has_request_context)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
-
-from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm
-from models import db, connect_db, User, Message, LikedMessage, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+from werkzeug.middleware.proxy_fix import ProxyFix
+from wtforms.validators import Optional, ValidationError
+
+from current_user import (
+    UserDeleted, UserSnapshotCache, resolve_current_user)
+from fragment_cache import FragmentCache
+from migrations import upgrade as upgrade_schema
+from query_stats import QueryStats
+from recommendations import refresh_recommendations
+from search import UserSearch, install_trigram_indexes
+from static_files import StaticFiles
+from throttle import (
+    LoginThrottle, MemoryStore, SharedStore, serve_shared_store)
+from timeline import HybridTimeline
+from forms import (
+    UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm)
+from password_hashing import HashingUnavailable, calibrate
+from models import (
+    db, connect_db, password_hasher, User, Message, LikedMessage,
+    TimelineEntry, Recommendation, DEFAULT_HEADER_IMAGE_URL,
+    DEFAULT_IMAGE_URL)
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+# The logged-in user's profile version, part of the `g.user` cache key.
+CURR_USER_VERSION_KEY = "curr_user_version"
+# When the user last proved they know their password (Unix time).
+RECENT_AUTH_KEY = "recent_auth"
+# Until when this browser reads from the primary database (Unix time).
+PRIMARY_UNTIL_KEY = "primary_until"
 
 app = Flask(__name__)
 
@@ -18,41 +53,272 @@ app = Flask(__name__)
 # if not set there, use development local db.
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
+# Read replicas, as comma-separated database URLs. GET and HEAD requests
+# read from them (see db_routing.py).
+replica_urls = [
+    url.strip().replace("postgres://", "postgresql://")
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()]
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{n}': url for n, url in enumerate(replica_urls)}
+app.config['SQLALCHEMY_REPLICA_BINDS'] = list(app.config['SQLALCHEMY_BINDS'])
+# Seconds a browser reads from the primary after one of its requests
+# wrote, so it sees its own writes despite replication lag.
+app.config['REPLICA_STICKY_SECONDS'] = 5
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+# bcrypt cost factor and hashing pool (see password_hashing.py); lower the
+# cost in development and tests, raise it as hardware gets faster.
+app.config['PASSWORD_HASH_ROUNDS'] = int(
+    os.environ.get('PASSWORD_HASH_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING', 8))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(
+    os.environ.get('PASSWORD_HASH_TIMEOUT', 5.0))
+# Login throttling state is kept per process unless a shared store
+# (`flask throttle-store`) is running at this "host:port".
+app.config['THROTTLE_STORE_ADDRESS'] = os.environ.get('THROTTLE_STORE_ADDRESS')
+# Proxies in front of the app (the Heroku router is one) whose
+# X-Forwarded-For is trusted for the client address that login throttling
+# limits per IP. Set to 0 when clients connect directly, or they could
+# send any address they like.
+app.config['PROXY_FIX_HOPS'] = int(os.environ.get('PROXY_FIX_HOPS', 1))
+# Seconds after entering their password that a user can edit their
+# profile or delete their account without entering it again.
+app.config['RECENT_AUTH_SECONDS'] = 5 * 60
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
+app.config['TIMELINE_PAGE_SIZE'] = 100
+app.config['FRAGMENT_CACHE_SIZE'] = 5000
+# Authors with this many followers have their messages pulled into
+# followers' timelines at read time instead of pushed on write.
+app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 10_000
+app.config['USER_SEARCH_LIMIT'] = 100
+# Seconds a cached `g.user` snapshot may lag a profile edit made in
+# another session.
+app.config['USER_SNAPSHOT_TTL'] = 60
+app.config['USERS_PAGE_SIZE'] = 60
+app.config['AUTOCOMPLETE_LIMIT'] = 10
+# Stored per user by `flask refresh-recommendations`; a few are shown.
+app.config['RECOMMENDATIONS_PER_USER'] = 10
+app.config['RECOMMENDATIONS_SHOWN'] = 5
+# Serve /_metrics (query stats per endpoint). Never enable in production.
+app.config['EXPOSE_METRICS'] = app.env != 'production'
 toolbar = DebugToolbarExtension(app)
 
+# Static files are served ahead of Flask, never reaching its request hooks.
+static_files = StaticFiles(
+    app.wsgi_app,
+    app.static_folder,
+    prefix=f"{app.static_url_path}/",
+    max_age=app.config['SEND_FILE_MAX_AGE_DEFAULT'],
+    autorefresh=app.debug)
+app.wsgi_app = static_files
+app.add_template_global(static_files.url, 'static_url')
+
+if app.config['PROXY_FIX_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_HOPS'])
+
 connect_db(app)
 
+query_stats = QueryStats(app)
+
+fragment_cache = FragmentCache(max_entries=app.config['FRAGMENT_CACHE_SIZE'])
+timeline = HybridTimeline(app.config['TIMELINE_CELEBRITY_THRESHOLD'])
+user_search = UserSearch()
+user_snapshots = UserSnapshotCache(ttl=app.config['USER_SNAPSHOT_TTL'])
+
+
+def warm_up():
+    """Build the username autocomplete index ahead of any request.
+
+    gunicorn runs this in each web worker as it starts (see
+    gunicorn.conf.py). Elsewhere, the index is built on first use.
+    """
+
+    with app.app_context():
+        user_search.load_usernames()
+
+
+def throttle_store_address():
+    """Return the shared throttle store's (host, port), or None."""
+
+    address = app.config['THROTTLE_STORE_ADDRESS']
+    if not address:
+        return None
+
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+login_throttle = LoginThrottle(
+    SharedStore(throttle_store_address(), app.config['SECRET_KEY'].encode())
+    if throttle_store_address() else MemoryStore())
+
 
 ##############################################################################
-# User signup/login/logout
+# Read replica routing
 
 
 @app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+def route_reads():
+    """Read from a replica on GET and HEAD, unless this browser just wrote."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if (app.config['SQLALCHEMY_REPLICA_BINDS']
+            and request.method in ('GET', 'HEAD')
+            and session.get(PRIMARY_UNTIL_KEY, 0) < time.time()):
+        db.session.info['use_replica'] = True
 
-    else:
-        g.user = None
 
+@app.after_request
+def stick_to_primary(response):
+    """Keep a browser on the primary for a moment after it writes."""
 
-@app.before_request
-def add_csrf_to_g():
-    """add CSRFProtection Form to Flask global"""
+    if (app.config['SQLALCHEMY_REPLICA_BINDS']
+            and db.session.info.get('wrote')):
+        session[PRIMARY_UNTIL_KEY] = (
+            time.time() + app.config['REPLICA_STICKY_SECONDS'])
+
+    return response
+
+
+##############################################################################
+# User signup/login/logout
+
+
+class Globals(app.app_ctx_globals_class):
+    """Flask's `g`, with attributes that are only made when first used.
+
+    - `g.user` is the logged-in user (a current_user.CurrentUser), or None.
+      Requests that never look at it never query for it.
+    - `g.csrf_form` is a CSRFProtectForm for templates' hidden_tag().
+      Making one generates and signs a CSRF token, so pages without a form
+      skip that. Views check tokens with `csrf_submitted()` instead.
+    """
+
+    def __getattr__(self, name):
+        if name == 'user':
+            self.user = self._current_user()
+            return self.user
+
+        if name == 'csrf_form':
+            self.csrf_form = CSRFProtectForm()
+            return self.csrf_form
+
+        return super().__getattr__(name)
+
+    @staticmethod
+    def _current_user():
+        if not has_request_context() or CURR_USER_KEY not in session:
+            return None
+
+        user = resolve_current_user(
+            user_snapshots,
+            session[CURR_USER_KEY],
+            session.get(CURR_USER_VERSION_KEY))
+
+        # Resync a version that is missing, or behind an edit made in
+        # another session, or this session would miss the cache for good.
+        if user is not None:
+            if session.get(CURR_USER_VERSION_KEY) != user.profile_version:
+                session[CURR_USER_VERSION_KEY] = user.profile_version
+
+        return user
+
+
+app.app_ctx_globals_class = Globals
+
+
+@app.errorhandler(UserDeleted)
+def logged_in_user_deleted(error):
+    """Log out a user deleted by another process since their snapshot was
+    cached, as if `g.user` had been None all along."""
+
+    user_snapshots.invalidate(error.user_id)
+    do_logout()
+    flash("Access unauthorized.", "danger")
+    return redirect("/")
+
+
+def csrf_submitted():
+    """Is this a form submission with a valid CSRF token?
+
+    What `CSRFProtectForm().validate_on_submit()` checks, without building
+    a form (or a token for the response) to do it.
+    """
+
+    if request.method != 'POST':
+        return False
+
+    if not app.config.get('WTF_CSRF_ENABLED', True):
+        return True
+
+    field_name = app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+    try:
+        validate_csrf(request.form.get(field_name))
+    except ValidationError:
+        return False
 
-    g.csrf_form = CSRFProtectForm()
+    return True
+
+
+def viewer_liked_ids(messages):
+    """Return ids of `messages` liked by the current user (one query)."""
+
+    return g.user.liked_ids_among(messages) if g.user else set()
+
+
+@app.template_global()
+def message_item(msg, liked_ids):
+    """Render a message's list <li>, reusing a cached fragment if we can.
+
+    The fragment only varies by message, author profile version and the
+    viewer's like state, so it is shared between viewers.
+    """
+
+    if g.user and msg.user_id == g.user.id:
+        like_state = "own"
+    elif msg.id in liked_ids:
+        like_state = "liked"
+    else:
+        like_state = "unliked"
+
+    return fragment_cache.get_or_render(
+        (msg.id, msg.user.profile_version, like_state),
+        msg.user_id,
+        lambda: render_template(
+            'messages/item.html', msg=msg, like_state=like_state))
 
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_VERSION_KEY] = user.profile_version
+    mark_authenticated()
+
+
+def mark_authenticated():
+    """Note that the logged-in user has just entered their password."""
+
+    session[RECENT_AUTH_KEY] = time.time()
+
+
+def recently_authenticated():
+    """Has the logged-in user entered their password within
+    RECENT_AUTH_SECONDS?
+
+    The session cookie is signed, so the timestamp can't be forged or
+    moved to another user's session.
+    """
+
+    authenticated_at = session.get(RECENT_AUTH_KEY)
+    return (authenticated_at is not None
+            and time.time() - authenticated_at
+            < app.config['RECENT_AUTH_SECONDS'])
 
 
 def do_logout():
@@ -60,7 +326,33 @@ def do_logout():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    session.pop(CURR_USER_VERSION_KEY, None)
+    session.pop(RECENT_AUTH_KEY, None)
+
+
+BUSY_MESSAGE = "We're very busy right now. Please try again in a moment."
+
+
+def retry_later(body, status=503, seconds=5):
+    """Return `body` as a `status` response asking to retry in `seconds`."""
+
+    response = make_response(body, status)
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+def throttled(username, template, **context):
+    """Return a 429 response if password checks for `username` (from this
+    client) are being throttled, else None."""
 
+    retry_after = login_throttle.allow(username, request.remote_addr)
+    if not retry_after:
+        return None
+
+    flash(f"Too many attempts. Please try again in {retry_after} seconds.",
+          'danger')
+    return retry_later(
+        render_template(template, **context), 429, retry_after)
 
 
 @app.route('/signup', methods=["GET", "POST"])
@@ -77,6 +369,7 @@ def signup():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    session.pop(CURR_USER_VERSION_KEY, None)
     form = UserAddForm()
 
     if form.validate_on_submit():
@@ -93,6 +386,12 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except HashingUnavailable:
+            flash(BUSY_MESSAGE, 'danger')
+            return retry_later(render_template('users/signup.html', form=form))
+
+        user_search.user_changed(user)
+
         do_login(user)
 
         return redirect("/")
@@ -108,15 +407,27 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(
-            form.username.data,
-            form.password.data)
+        rejected = throttled(form.username.data, 'users/login.html', form=form)
+        if rejected:
+            return rejected
+
+        try:
+            user = User.authenticate(
+                form.username.data,
+                form.password.data)
+        except HashingUnavailable:
+            flash(BUSY_MESSAGE, 'danger')
+            return retry_later(render_template('users/login.html', form=form))
 
         if user:
+            # Keeps the hash if `authenticate` upgraded its cost factor.
+            db.session.commit()
+            login_throttle.succeeded(user.username, request.remote_addr)
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
+        login_throttle.failed(form.username.data, request.remote_addr)
         flash("Invalid credentials.", 'danger')
 
     return render_template('users/login.html', form=form)
@@ -127,13 +438,10 @@ def logout():
     """Handle logout of user and redirect to homepage."""
 
     if CURR_USER_KEY in session:
-        form = g.csrf_form
-
-        if form.validate_on_submit():
+        if csrf_submitted():
             do_logout()
             flash("You've been logged out")
 
-
     return redirect("/")
 
 
@@ -142,9 +450,13 @@ def logout():
 
 @app.get('/users')
 def list_users():
-    """Page with listing of users.
+    """Page with listing of users, in username order.
+
+    Can take a 'q' param in querystring to search usernames and bios
+    (case-insensitive, best matches first; see search.py).
 
-    Can take a 'q' param in querystring to search by that username.
+    Otherwise shows USERS_PAGE_SIZE users at a time; takes an optional
+    'after' param (a username) to continue from the previous page.
     """
 
     if not g.user:
@@ -152,13 +464,50 @@ def list_users():
         return redirect("/")
 
     search = request.args.get('q')
+    next_url = None
 
     if not search:
-        users = User.query.all()
+        page_size = app.config['USERS_PAGE_SIZE']
+        query = User.query.order_by(User.username)
+
+        after = request.args.get('after')
+        if after:
+            query = query.filter(User.username > after)
+
+        users = query.limit(page_size + 1).all()
+        if len(users) > page_size:
+            users = users[:page_size]
+            next_url = url_for('list_users', after=users[-1].username)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = user_search.search(
+            search, limit=app.config['USER_SEARCH_LIMIT'])
+
+    return stream_template(
+        'users/index.html',
+        users=users,
+        following_ids=g.user.following_ids_among(users),
+        next_url=next_url)
+
 
-    return render_template('users/index.html', users=users)
+@app.get('/users/autocomplete')
+def autocomplete_users():
+    """Return JSON usernames starting with the 'q' param, for type-ahead:
+
+    {"users": [{"id": 1, "username": "..."}, ...]}
+
+    Served from memory (see search.UsernamePrefixIndex), not the database.
+    """
+
+    if not g.user:
+        abort(401)
+
+    prefix = request.args.get('q', '')
+    limit = app.config['AUTOCOMPLETE_LIMIT']
+
+    return jsonify(users=[
+        {"id": user_id, "username": username}
+        for user_id, username in user_search.autocomplete(prefix, limit)
+    ])
 
 
 @app.get('/users/<int:user_id>')
@@ -171,7 +520,15 @@ def show_user(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    return render_template('users/show.html', user=user)
+    etag = page_etag('user', user.id, user.version)
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    liked_ids = viewer_liked_ids(user.messages)
+
+    return revalidated(
+        render_template('users/show.html', user=user, liked_ids=liked_ids),
+        etag)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -183,7 +540,22 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users, next_url = user_page(User.followed_by(user.id), user_id=user.id)
+
+    etag = page_etag(
+        'following', user.id, user.version, next_url,
+        [(u.id, u.version) for u in users])
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    return revalidated(
+        render_template(
+            'users/following.html',
+            user=user,
+            users=users,
+            following_ids=g.user.following_ids_among(users),
+            next_url=next_url),
+        etag)
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -195,10 +567,28 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users, next_url = user_page(User.followers_of(user.id), user_id=user.id)
+
+    etag = page_etag(
+        'followers', user.id, user.version, next_url,
+        [(u.id, u.version) for u in users])
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    return revalidated(
+        render_template(
+            'users/followers.html',
+            user=user,
+            users=users,
+            following_ids=g.user.following_ids_among(users),
+            next_url=next_url),
+        etag)
+
+
+##############################################################################
+# Liked messages
+
 
-#############################################################
-## New code show liked messages
 @app.get('/users/<int:user_id>/likes')
 def show_liked_messages(user_id):
     """Show list of this user's liked messages."""
@@ -208,7 +598,14 @@ def show_liked_messages(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/liked-messages.html', user=user)
+    messages = Message.liked_by(user.id).all()
+    liked_ids = viewer_liked_ids(messages)
+
+    return render_template(
+        'users/liked-messages.html',
+        user=user,
+        messages=messages,
+        liked_ids=liked_ids)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -222,10 +619,11 @@ def start_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-
-
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    User.bump([g.user.id], following_count=1)
+    User.bump([followed_user.id], followers_count=1)
+    timeline.follow(g.user.id, followed_user)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -244,6 +642,9 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    User.bump([g.user.id], following_count=-1)
+    User.bump([followed_user.id], followers_count=-1)
+    timeline.unfollow(g.user.id, followed_user)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -259,53 +660,84 @@ def profile():
         return redirect("/")
 
     form = UserEditForm(obj=g.user)
-
+    # Skip the password (and bcrypt) if it was entered a moment ago.
+    confirm_password = not recently_authenticated()
+    if not confirm_password:
+        form.password.validators = [Optional()]
 
     if form.validate_on_submit():
-        password = request.form.get('password')
-
-        # Check authorized Username/Password
-        if not User.authenticate(g.user.username,password):
-            flash("Access unauthorized.", "danger")
-            return redirect("/users/profile")
+        if confirm_password:
+            password = request.form.get('password', '')
+
+            rejected = throttled(
+                g.user.username, 'users/edit.html',
+                form=form, confirm_password=True)
+            if rejected:
+                return rejected
+
+            # Check authorized Username/Password
+            try:
+                authenticated = User.authenticate(g.user.username, password)
+            except HashingUnavailable:
+                flash(BUSY_MESSAGE, 'danger')
+                return retry_later(render_template(
+                    'users/edit.html', form=form, confirm_password=True))
+
+            if not authenticated:
+                login_throttle.failed(g.user.username, request.remote_addr)
+                flash("Access unauthorized.", "danger")
+                return redirect("/users/profile")
+
+            login_throttle.succeeded(g.user.username, request.remote_addr)
+            mark_authenticated()
 
         g.user.username = form.username.data or g.user.username
         g.user.email = form.email.data or g.user.email
         g.user.image_url = form.image_url.data or DEFAULT_IMAGE_URL
         g.user.header_image_url = (form.header_image_url.data
-                                    or DEFAULT_HEADER_IMAGE_URL)
+                                   or DEFAULT_HEADER_IMAGE_URL)
         g.user.bio = form.bio.data
+        g.user.profile_version += 1
+        g.user.version += 1
 
         db.session.commit()
+        session[CURR_USER_VERSION_KEY] = g.user.profile_version
+        user_snapshots.invalidate(g.user.id)
+        fragment_cache.invalidate_author(g.user.id)
+        user_search.user_changed(g.user)
 
         return redirect(f'/users/{g.user.id}')
 
-    return render_template('users/edit.html', form=form)
-
-
-
-
+    return render_template(
+        'users/edit.html', form=form, confirm_password=confirm_password)
 
 
 @app.post('/users/delete')
 def delete_user():
     """Delete user.
 
-    Redirect to signup page.
+    Redirect to signup page. Users who haven't entered their password
+    within RECENT_AUTH_SECONDS are asked to log in again first.
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    if CURR_USER_KEY in session:
-        form = g.csrf_form
+    if not recently_authenticated():
+        flash("Please log in again to delete your account.", "warning")
+        return redirect("/login")
 
-        if form.validate_on_submit():
+    if CURR_USER_KEY in session:
+        if csrf_submitted():
             do_logout()
 
-            db.session.delete(g.user)
+            user_id = g.user.id
+            g.user.release_counts()
+            db.session.delete(g.user.model)
             db.session.commit()
+            user_snapshots.invalidate(user_id)
+            user_search.user_removed(user_id)
 
     return redirect("/signup")
 
@@ -329,6 +761,9 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        User.bump([g.user.id], messages_count=1)
+        db.session.flush()
+        timeline.publish(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -343,9 +778,20 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    # breakpoint()
-    return render_template('messages/show.html', message=msg)
+    msg = Message.with_authors().filter_by(id=message_id).first_or_404()
+
+    # Messages never change once posted, so the author's version (name,
+    # image, follow counts) is all that can move on this page.
+    etag = page_etag('message', msg.id, msg.user.version)
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    liked_ids = viewer_liked_ids([msg])
+
+    return revalidated(
+        render_template(
+            'messages/show.html', message=msg, liked_ids=liked_ids),
+        etag)
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -360,18 +806,22 @@ def delete_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    form = g.csrf_form
-
-    if form.validate_on_submit():
+    if csrf_submitted():
         msg = Message.query.get_or_404(message_id)
+        User.bump([msg.user_id], messages_count=-1)
+        User.bump(
+            select(LikedMessage.user_liking_message_id)
+            .where(LikedMessage.message_being_liked_id == msg.id),
+            likes_count=-1)
         db.session.delete(msg)
         db.session.commit()
+        fragment_cache.invalidate_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
 ##############################################################################
-#User Liked Message Routes
+# User Liked Message Routes
 
 @app.post('/messages/<int:msg_id>/like')
 def like_message(msg_id):
@@ -388,9 +838,11 @@ def like_message(msg_id):
     liked_message = Message.query.get_or_404(msg_id)
     if not liked_message.user_id == g.user.id:
         g.user.liked_messages.append(liked_message)
+        User.bump([g.user.id], likes_count=1)
         db.session.commit()
 
-    return redirect(f"/")
+    return redirect("/")
+
 
 @app.post('/messages/<int:msg_id>/unlike')
 def unlike_message(msg_id):
@@ -403,10 +855,10 @@ def unlike_message(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-
     liked_message = Message.query.get_or_404(msg_id)
     if not liked_message.user_id == g.user.id:
         g.user.liked_messages.remove(liked_message)
+        User.bump([g.user.id], likes_count=-1)
 
         db.session.commit()
 
@@ -417,42 +869,281 @@ def unlike_message(msg_id):
 # Homepage and error pages
 
 
+def user_page(query, **url_values):
+    """Return (users, next page URL or None) for a query in user id order.
+
+    Reads the 'after' param (a user id; 400 if malformed) to continue from
+    the previous page, and returns at most USERS_PAGE_SIZE users.
+    """
+
+    page_size = app.config['USERS_PAGE_SIZE']
+
+    after = request.args.get('after')
+    if after:
+        try:
+            query = query.filter(User.id > int(after))
+        except ValueError:
+            abort(400)
+
+    users = query.limit(page_size + 1).all()
+    if len(users) <= page_size:
+        return users, None
+
+    users = users[:page_size]
+    return users, url_for(
+        request.endpoint, after=users[-1].id, **url_values)
+
+
+def stream_template(template_name, **context):
+    """Render `template_name` into a streamed response.
+
+    The session cookie is sent with the headers, before the template runs,
+    so anything the template would write to the session (the CSRF token,
+    popping flashed messages) is done up front. Queries should be done up
+    front too, so they're counted in this request's query stats.
+    """
+
+    generate_csrf()
+    get_flashed_messages()
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    return Response(stream_with_context(template.stream(context)))
+
+
+def parse_cursor(cursor):
+    """Parse a '<iso timestamp>,<message id>' cursor; 400 if malformed."""
+
+    try:
+        timestamp, message_id = cursor.rsplit(',', 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except ValueError:
+        abort(400)
+
+
+def make_cursor(message):
+    """Return the keyset cursor that continues after `message`."""
+
+    return f"{message.timestamp.isoformat()},{message.id}"
+
+
 @app.get('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, read from the
+      user's precomputed timeline (see timeline.HybridTimeline)
+
+    Takes an optional 'before' cursor ('<timestamp>,<message id>') to page
+    back through older messages. With 'partial=1' only the message <li>
+    items are rendered, and the cursor for the following page is sent in
+    the X-Next-Cursor header, so the client can append pages in place.
     """
 
     if g.user:
-        following_and_own_ids = [f.id for f in g.user.following]
-        following_and_own_ids.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_and_own_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        page_size = app.config['TIMELINE_PAGE_SIZE']
+        before = request.args.get('before')
+        before = parse_cursor(before) if before else None
+
+        messages = timeline.page(g.user.id, limit=page_size, before=before)
+        next_cursor = (make_cursor(messages[-1])
+                       if len(messages) == page_size else None)
+        liked_ids = viewer_liked_ids(messages)
+
+        if request.args.get('partial'):
+            response = make_response(render_template(
+                'messages/timeline-items.html',
+                messages=messages,
+                liked_ids=liked_ids))
+            if next_cursor:
+                response.headers['X-Next-Cursor'] = next_cursor
+            return response
+
+        return render_template(
+            'home.html',
+            messages=messages,
+            liked_ids=liked_ids,
+            next_cursor=next_cursor,
+            who_to_follow=Recommendation.users_for(
+                g.user.id, limit=app.config['RECOMMENDATIONS_SHOWN']))
+
+    else:
+        return render_template('home-anon.html')
+
+
+@app.get('/_metrics')
+def metrics():
+    """Return internal performance counters as JSON (non-production only)."""
+
+    if not app.config['EXPOSE_METRICS']:
+        abort(404)
+
+    return jsonify(
+        queries=query_stats.report(),
+        password_hashing=password_hasher.stats(),
+        login_throttle=login_throttle.stats())
 
 
-        return render_template('home.html', messages=messages)
+@app.cli.command('migrate')
+def migrate_command():
+    """Bring an existing database's schema up to date."""
 
+    applied = upgrade_schema()
+    for migration in applied:
+        click.echo(f"Applied {migration.version}: {migration.description}")
+    if not applied:
+        click.echo("Schema is up to date.")
+
+
+@app.cli.command('install-search-indexes')
+def install_search_indexes():
+    """Add pg_trgm trigram indexes for user search, where available."""
+
+    if install_trigram_indexes():
+        db.session.commit()
+        click.echo("Trigram indexes installed.")
     else:
-        return render_template('home-anon.html')
+        db.session.rollback()
+        click.echo("pg_trgm is unavailable; search uses the in-process index.")
+
+
+@app.cli.command('recount-users')
+def recount_users():
+    """Repair drift in users' denormalized message/follow/like counts."""
+
+    User.recount()
+    db.session.commit()
+
+
+@app.cli.command('rebuild-timelines')
+@click.option('--user-id', type=int, help="Only rebuild this user's.")
+def rebuild_timelines(user_id):
+    """Recompute users' home timelines from messages and follows."""
+
+    TimelineEntry.rebuild(owner_id=user_id)
+    db.session.commit()
+
+
+@app.cli.command('refresh-recommendations')
+@click.option('--every', type=int, metavar='SECONDS',
+              help="Keep running, refreshing every SECONDS.")
+def refresh_recommendations_command(every):
+    """Recompute every user's "who to follow" recommendations.
+
+    Run it from a scheduler (cron, Heroku Scheduler), or as a worker
+    process with --every.
+    """
+
+    while True:
+        start = time.monotonic()
+        stored = refresh_recommendations(
+            per_user=app.config['RECOMMENDATIONS_PER_USER'])
+        db.session.commit()
+        click.echo(f"Stored {stored} recommendations "
+                   f"in {time.monotonic() - start:.1f}s")
+
+        if not every:
+            break
+        db.session.remove()
+        time.sleep(every)
+
+
+@app.cli.command('calibrate-password-hashing')
+@click.option('--target-ms', type=float, default=250, show_default=True,
+              help="Longest acceptable time for one hash.")
+def calibrate_password_hashing(target_ms):
+    """Time bcrypt on this host and suggest PASSWORD_HASH_ROUNDS.
+
+    Run it on the hardware that will serve logins. Stored hashes move to
+    a new cost factor as their users log in.
+    """
+
+    rounds, timings = calibrate(target_ms)
+
+    for cost, ms in timings.items():
+        marker = "  <-" if cost == rounds else ""
+        click.echo(f"cost {cost:2}: {ms:8.1f} ms{marker}")
+
+    click.echo(f"\nPASSWORD_HASH_ROUNDS={rounds} "
+               f"(currently {app.config['PASSWORD_HASH_ROUNDS']})")
+
+
+@app.cli.command('throttle-store')
+def throttle_store_command():
+    """Serve login throttle state to every web process.
+
+    Listens at THROTTLE_STORE_ADDRESS; set the same address for the web
+    processes (they share SECRET_KEY as the connection key).
+    """
+
+    address = throttle_store_address()
+    if address is None:
+        raise click.UsageError("THROTTLE_STORE_ADDRESS is not set.")
+
+    click.echo(f"Serving login throttle state at {address[0]}:{address[1]}")
+    serve_shared_store(address, app.config['SECRET_KEY'].encode())
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# HTTP caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages that can build a validator from version stamps (see `page_etag`)
+# are stored by the browser but revalidated on every visit; a matching
+# If-None-Match gets a 304 before any template renders. Static files get a
+# max-age (SEND_FILE_MAX_AGE_DEFAULT). Everything else is never stored.
+
+
+def page_etag(*stamps):
+    """Return an ETag for a page built from the version stamps it shows.
+
+    The viewer's own id and version are always mixed in: their follow and
+    like state, and their name and image in the nav bar, are on every
+    page. So is the current CSRF token epoch, so a revalidated page never
+    carries a form token older than WTF_CSRF_TIME_LIMIT.
+    """
+
+    viewer = (g.user.id, g.user.version) if g.user else None
+    csrf_time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf_epoch = (int(time.time() // (csrf_time_limit / 2))
+                  if csrf_time_limit else None)
+
+    return hashlib.sha1(
+        repr((stamps, viewer, csrf_epoch)).encode()).hexdigest()
+
+
+def is_fresh(etag):
+    """Does the client already hold the current version of this page?
+
+    Never true while flashed messages are waiting to be shown.
+    """
+
+    return (request.if_none_match.contains_weak(etag)
+            and not session.get('_flashes'))
+
+
+def not_modified(etag):
+    """Return an empty 304 response for `etag`."""
+
+    return revalidated(make_response('', 304), etag)
+
+
+def revalidated(response, etag):
+    """Make `response` cacheable by the browser, revalidated on each use."""
+
+    response = make_response(response)
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers unless a route chose a caching policy."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if not response.cache_control:
+        response.cache_control.no_store = True
     return response
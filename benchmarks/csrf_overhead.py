@@ -0,0 +1,64 @@
+"""Benchmark per-request CSRF overhead, eager vs. lazy.
+
+"eager" re-adds the old before_request hook that built a CSRFProtectForm
+(generating and signing a token) for every request; "lazy" is the app as
+it is, which only builds one when `g.csrf_form` is used. Requests are
+made without cookies, as from a new visitor or an API client, so each
+one starts with an empty session.
+
+    python -m benchmarks.csrf_overhead --requests 2000
+"""
+
+import argparse
+
+from flask import g
+
+from benchmarks.helpers import db, reset_db, timed, report
+from app import app
+from forms import CSRFProtectForm
+from models import User
+
+
+def add_csrf_to_g():
+    g.csrf_form = CSRFProtectForm()
+
+
+def per_request(client, url, count):
+    def run():
+        for _ in range(count):
+            client.get(url)
+
+    return timed(run, repeat=5) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    reset_db()
+    User.signup("bench", "bench@example.com", "password", None)
+    db.session.commit()
+    app.config['WTF_CSRF_ENABLED'] = True
+
+    client = app.test_client(use_cookies=False)
+    urls = {
+        "anonymous home page": "/",
+        "JSON autocomplete (logged out, 401)": "/users/autocomplete?q=b",
+    }
+
+    for label, url in urls.items():
+        lazy = per_request(client, url, args.requests)
+
+        app.before_request_funcs.setdefault(None, []).append(add_csrf_to_g)
+        try:
+            eager = per_request(client, url, args.requests)
+        finally:
+            app.before_request_funcs[None].remove(add_csrf_to_g)
+
+        report(f"{label}: eager", eager)
+        report(f"{label}: lazy", lazy)
+
+
+if __name__ == "__main__":
+    main()
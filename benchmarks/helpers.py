@@ -0,0 +1,86 @@
+"""Support functions for the benchmarks.
+
+Benchmarks run against their own database (BENCH_DATABASE_URL, default
+postgresql:///warbler_bench), which they drop and recreate, so they never
+touch development data. Run them from the project root as modules, e.g.:
+
+    createdb warbler_bench
+    python -m benchmarks.timeline_query
+"""
+
+import os
+import statistics
+import time
+
+# Like the tests, point the app at its own database before importing it.
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+
+from app import app  # noqa: E402
+from models import db  # noqa: E402
+
+app.config['DEBUG_TB_ENABLED'] = False
+
+
+def reset_db():
+    """Drop and recreate every table in the benchmark database."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def bulk_insert(model, rows, batch_size=10_000):
+    """Insert a list of row dicts for `model` in large batches."""
+
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(
+            model.__table__.insert(), rows[start:start + batch_size])
+    db.session.commit()
+
+
+def fake_users(count, start=1):
+    """Return `count` user rows with ids starting at `start`.
+
+    The password is not a real hash; benchmarks never log these users in.
+    """
+
+    return [
+        dict(
+            id=i,
+            username=f"user{i}",
+            email=f"user{i}@example.com",
+            password="not-a-hash",
+            bio=f"Bio of user {i}",
+        )
+        for i in range(start, start + count)
+    ]
+
+
+def reset_id_sequence(model):
+    """Move a table's id sequence past ids inserted explicitly."""
+
+    table = model.__tablename__
+    db.session.execute(db.text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+        f"(SELECT max(id) FROM {table}))"))
+    db.session.commit()
+
+
+def timed(fn, repeat=5):
+    """Call `fn` `repeat` times; return the median wall time in seconds."""
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    return statistics.median(samples)
+
+
+def report(label, seconds):
+    """Print one benchmark result line."""
+
+    print(f"{label:<48} {seconds * 1000:10.2f} ms")
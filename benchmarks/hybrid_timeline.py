@@ -0,0 +1,188 @@
+"""Benchmark push, pull and hybrid home timelines on skewed follow graphs.
+
+Users and messages come from the generator/ CSVs, copied `--scale` times.
+The follow graph is redrawn so that follower counts follow a power law
+(Zipf, exponent `--alpha`), like real social graphs: a few accounts are
+followed by a large share of users, most by almost nobody. Each user
+follows as many accounts, on average, as in generator/follows.csv.
+
+For each strategy this reports the cost of publishing a message by the
+most-followed account and by a typical one, the time to read a page of
+home timeline for a sample of users, and the size of the inbox table.
+
+    python -m benchmarks.hybrid_timeline --scale 20 --threshold 500
+"""
+
+import argparse
+import csv
+from itertools import accumulate
+from random import choices, sample, seed, shuffle
+
+from benchmarks.helpers import (
+    db, reset_db, bulk_insert, reset_id_sequence, timed, report)
+from models import User, Message, Follows, TimelineEntry
+from timeline import HybridTimeline
+
+PAGE_SIZE = 100
+SAMPLE_READERS = 50
+POSTS_PER_AUTHOR = 20
+
+
+def read_csv(name):
+    with open(f'generator/{name}.csv') as f:
+        return list(csv.DictReader(f))
+
+
+def build_dataset(scale, alpha):
+    """Load the scaled, power-law dataset; return the number of users."""
+
+    seed(0)
+    reset_db()
+
+    users = read_csv('users')
+    messages = read_csv('messages')
+    num_follows = len(read_csv('follows'))
+    per_copy = len(users)
+    num_users = per_copy * scale
+
+    bulk_insert(User, [
+        dict(user,
+             id=copy * per_copy + i,
+             username=f"{user['username']}{copy}",
+             email=f"{copy}.{user['email']}")
+        for copy in range(scale)
+        for i, user in enumerate(users, start=1)
+    ])
+    bulk_insert(Message, [
+        dict(msg, user_id=copy * per_copy + int(msg['user_id']))
+        for copy in range(scale)
+        for msg in messages
+    ])
+
+    # Popularity rank r gets weight 1 / r ** alpha; ranks are shuffled so
+    # popularity is unrelated to id.
+    ranked_ids = list(range(1, num_users + 1))
+    shuffle(ranked_ids)
+    cum_weights = list(accumulate(
+        1 / rank ** alpha for rank in range(1, num_users + 1)))
+    follows_per_user = num_follows // per_copy
+
+    follows = set()
+    for follower_id in range(1, num_users + 1):
+        for followed_id in choices(
+                ranked_ids, cum_weights=cum_weights, k=follows_per_user):
+            if followed_id != follower_id:
+                follows.add((followed_id, follower_id))
+
+    bulk_insert(Follows, [
+        dict(user_being_followed_id=followed, user_following_id=follower)
+        for followed, follower in follows
+    ])
+
+    reset_id_sequence(User)
+    reset_id_sequence(Message)
+    User.recount()
+    db.session.commit()
+
+    return num_users
+
+
+def publish_cost(timeline, author_id):
+    """Median time to publish one message by `author_id` (rolled back)."""
+
+    author = User.query.get(author_id)
+
+    def publish():
+        msg = Message(text="Benchmark warble", user=author)
+        db.session.add(msg)
+        db.session.flush()
+        timeline.publish(msg)
+
+    seconds = timed(publish, repeat=POSTS_PER_AUTHOR)
+    db.session.rollback()
+    return seconds
+
+
+def read_cost(read, reader_ids):
+    """Median over `reader_ids` of the time to read one page."""
+
+    def read_all():
+        for reader_id in reader_ids:
+            db.session.expunge_all()
+            read(reader_id)
+
+    return timed(read_all, repeat=3) / len(reader_ids)
+
+
+def inbox_rows():
+    return TimelineEntry.query.count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--scale', type=int, default=20)
+    parser.add_argument('--alpha', type=float, default=1.1)
+    parser.add_argument('--threshold', type=int, default=500)
+    args = parser.parse_args()
+
+    num_users = build_dataset(args.scale, args.alpha)
+
+    by_followers = User.query.order_by(User.followers_count.desc()).all()
+    top, typical = by_followers[0], by_followers[len(by_followers) // 2]
+    popular = [u.id for u in by_followers
+               if u.followers_count >= args.threshold]
+    reader_ids = sample(range(1, num_users + 1), SAMPLE_READERS)
+
+    print(f"{num_users:,} users, {Follows.query.count():,} follows, "
+          f"{Message.query.count():,} messages")
+    top_id, typical_id = top.id, typical.id
+    print(f"most followed: {top.followers_count:,} followers; "
+          f"median: {typical.followers_count:,}; "
+          f"{len(popular)} accounts at or over --threshold "
+          f"{args.threshold}")
+    print()
+
+    push = HybridTimeline(celebrity_threshold=None)
+    hybrid = HybridTimeline(celebrity_threshold=args.threshold)
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+
+    report("push: publish by most followed", publish_cost(push, top_id))
+    report("push: publish by median", publish_cost(push, typical_id))
+    report("push: read one page", read_cost(
+        lambda reader_id: push.page(reader_id, limit=PAGE_SIZE),
+        reader_ids))
+    print(f"{'push: inbox rows':<48} {inbox_rows():>10,}")
+    print()
+
+    report("pull: read one page", read_cost(
+        lambda reader_id: (Message
+                           .timeline_for(reader_id)
+                           .limit(PAGE_SIZE)
+                           .all()),
+        reader_ids))
+    print()
+
+    # The hybrid inbox holds everything except popular authors' messages
+    # in other users' timelines.
+    (TimelineEntry.query
+        .filter(TimelineEntry.author_id.in_(popular))
+        .filter(TimelineEntry.owner_id != TimelineEntry.author_id)
+        .delete(synchronize_session=False))
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+
+    report("hybrid: publish by most followed", publish_cost(hybrid, top_id))
+    report("hybrid: publish by median", publish_cost(hybrid, typical_id))
+    report("hybrid: read one page", read_cost(
+        lambda reader_id: hybrid.page(reader_id, limit=PAGE_SIZE),
+        reader_ids))
+    print(f"{'hybrid: inbox rows':<48} {inbox_rows():>10,}")
+
+
+if __name__ == "__main__":
+    main()
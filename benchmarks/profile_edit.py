@@ -0,0 +1,71 @@
+"""Benchmark profile edit throughput, with and without a recent login.
+
+"re-enter password" is every edit confirming the password with a full
+bcrypt check, as when the last login is older than RECENT_AUTH_SECONDS;
+"recently authenticated" is edits made within that window, which skip
+it. Hashing runs at the configured PASSWORD_HASH_ROUNDS, so set that as
+in production.
+
+    python -m benchmarks.profile_edit --edits 50
+"""
+
+import argparse
+import time
+
+from benchmarks.helpers import db, reset_db, timed, report
+from app import app, login_throttle, CURR_USER_KEY, RECENT_AUTH_KEY
+from models import User
+
+
+def per_edit(client, count, password=None):
+    data = {"bio": "Benchmarking"}
+    if password is not None:
+        data["password"] = password
+
+    def run():
+        for _ in range(count):
+            response = client.post("/users/profile", data=data)
+            assert response.status_code == 302, response.status_code
+
+    return timed(run, repeat=3) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--edits', type=int, default=50)
+    args = parser.parse_args()
+
+    reset_db()
+    user = User.signup("bench", "bench@example.com", "password", None)
+    db.session.commit()
+    app.config['WTF_CSRF_ENABLED'] = False
+    # Throttling would cap the password path at a few edits a minute.
+    for kind in login_throttle.limits:
+        login_throttle.limits[kind] = (10**9, 10**9, 10**9)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = user.id
+        session[RECENT_AUTH_KEY] = (
+            time.time() - app.config['RECENT_AUTH_SECONDS'] - 1)
+
+    # Each confirmed edit refreshes the marker; keep it stale.
+    recent_auth_seconds = app.config['RECENT_AUTH_SECONDS']
+    app.config['RECENT_AUTH_SECONDS'] = 0
+    try:
+        confirmed = per_edit(client, args.edits, password="password")
+    finally:
+        app.config['RECENT_AUTH_SECONDS'] = recent_auth_seconds
+
+    with client.session_transaction() as session:
+        session[RECENT_AUTH_KEY] = time.time()
+    recent = per_edit(client, args.edits)
+
+    print(f"bcrypt cost factor {app.config['PASSWORD_HASH_ROUNDS']}")
+    report("re-enter password", confirmed)
+    report("recently authenticated", recent)
+    print(f"{1 / confirmed:.0f} vs {1 / recent:.0f} edits/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Benchmark full-graph "who to follow" recomputation.
+
+Times recommendations.recommend() (sparse scoring plus per-user top-k) on
+generator/follows.csv as is, then on power-law follow graphs (Zipf,
+exponent `--alpha`) with each user following as many accounts, on average,
+as in the generator data, at increasing numbers of users. With --database
+it also times the whole `refresh_recommendations()` job (load follows,
+score, replace the recommendations table) on the largest graph.
+
+    python -m benchmarks.recommendations --users 10000 100000 1000000
+"""
+
+import argparse
+import csv
+
+import numpy as np
+
+from benchmarks.helpers import (
+    db, reset_db, bulk_insert, fake_users, timed, report)
+from models import User, Follows, Recommendation
+from recommendations import recommend, refresh_recommendations
+
+
+def generator_edges():
+    """Return generator/follows.csv as (follower, followed) rows."""
+
+    with open('generator/follows.csv') as f:
+        return np.array(
+            [(int(row['user_following_id']),
+              int(row['user_being_followed_id']))
+             for row in csv.DictReader(f)],
+            dtype=np.int64)
+
+
+def power_law_edges(num_users, follows_per_user, alpha, rng):
+    """Return a random follow graph with Zipf-distributed popularity."""
+
+    weights = 1 / np.arange(1, num_users + 1) ** alpha
+    popularity = rng.permutation(num_users) + 1
+
+    followers = np.repeat(np.arange(1, num_users + 1), follows_per_user)
+    followed = popularity[rng.choice(
+        num_users, size=len(followers), p=weights / weights.sum())]
+
+    edges = np.unique(np.column_stack((followers, followed)), axis=0)
+    return edges[edges[:, 0] != edges[:, 1]]
+
+
+def benchmark(label, edges, repeat):
+    user_ids = np.unique(edges)
+
+    def run():
+        for _ in recommend(user_ids, edges):
+            pass
+
+    seconds = timed(run, repeat=repeat)
+    report(f"{label}: {len(user_ids):,} users, {len(edges):,} follows",
+           seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, nargs='+',
+                        default=[10_000, 100_000])
+    parser.add_argument('--alpha', type=float, default=1.0)
+    parser.add_argument('--database', action='store_true')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    edges = generator_edges()
+    benchmark("generator/follows.csv", edges, repeat=5)
+
+    follows_per_user = len(edges) // len(np.unique(edges[:, 0]))
+    for num_users in args.users:
+        edges = power_law_edges(num_users, follows_per_user, args.alpha, rng)
+        benchmark("power law", edges, repeat=1)
+
+    if args.database:
+        print()
+        reset_db()
+        bulk_insert(User, fake_users(num_users), batch_size=50_000)
+        bulk_insert(Follows, [
+            dict(user_following_id=int(follower),
+                 user_being_followed_id=int(followed))
+            for follower, followed in edges
+        ], batch_size=50_000)
+
+        def refresh():
+            refresh_recommendations()
+            db.session.commit()
+
+        report(f"refresh_recommendations(): {num_users:,} users",
+               timed(refresh, repeat=1))
+        print(f"{Recommendation.query.count():,} recommendations stored")
+
+
+if __name__ == "__main__":
+    main()
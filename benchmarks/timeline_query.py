@@ -0,0 +1,100 @@
+"""Benchmark the fan-in home timeline query.
+
+Compares the original approach (hydrate `user.following`, then query with
+an IN list of their ids) against `Message.timeline_for()`, which consults
+`follows` in a subquery, for viewers following 10, 1k and 50k users.
+
+    python -m benchmarks.timeline_query
+"""
+
+from datetime import datetime, timedelta
+from random import randint, seed
+
+from benchmarks.helpers import (
+    db, reset_db, bulk_insert, fake_users, reset_id_sequence, timed, report)
+from models import User, Message, Follows
+
+FOLLOW_COUNTS = [10, 1_000, 50_000]
+NUM_AUTHORS = max(FOLLOW_COUNTS)
+MESSAGES_PER_AUTHOR = 2
+PAGE_SIZE = 100
+
+
+def build_dataset():
+    """Create authors with messages, plus one viewer per follow count.
+
+    Returns {follow count: viewer id}.
+    """
+
+    seed(0)
+    reset_db()
+
+    now = datetime.utcnow()
+    bulk_insert(User, fake_users(NUM_AUTHORS + len(FOLLOW_COUNTS)))
+    bulk_insert(Message, [
+        dict(
+            text=f"Message {n} by {author_id}",
+            timestamp=now - timedelta(minutes=randint(0, 500_000)),
+            user_id=author_id,
+        )
+        for author_id in range(1, NUM_AUTHORS + 1)
+        for n in range(MESSAGES_PER_AUTHOR)
+    ])
+
+    viewers = {}
+    for offset, follow_count in enumerate(FOLLOW_COUNTS, start=1):
+        viewer_id = NUM_AUTHORS + offset
+        viewers[follow_count] = viewer_id
+        bulk_insert(Follows, [
+            dict(user_being_followed_id=author_id,
+                 user_following_id=viewer_id)
+            for author_id in range(1, follow_count + 1)
+        ])
+
+    reset_id_sequence(User)
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+
+    return viewers
+
+
+def hydrated_in_query(viewer_id):
+    """The original homepage(): load following, then an IN query."""
+
+    db.session.expunge_all()
+    viewer = User.query.get(viewer_id)
+
+    following_and_own_ids = [f.id for f in viewer.following]
+    following_and_own_ids.append(viewer.id)
+
+    return (Message
+            .query
+            .filter(Message.user_id.in_(following_and_own_ids))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(PAGE_SIZE)
+            .all())
+
+
+def single_statement(viewer_id):
+    """One statement with a subquery on follows."""
+
+    db.session.expunge_all()
+
+    return Message.timeline_for(viewer_id).limit(PAGE_SIZE).all()
+
+
+def main():
+    viewers = build_dataset()
+
+    for follow_count, viewer_id in viewers.items():
+        assert ([m.id for m in hydrated_in_query(viewer_id)]
+                == [m.id for m in single_statement(viewer_id)])
+
+        report(f"hydrated following + IN ({follow_count:,} follows)",
+               timed(lambda: hydrated_in_query(viewer_id)))
+        report(f"single statement ({follow_count:,} follows)",
+               timed(lambda: single_statement(viewer_id)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Benchmark user search at a million users.
+
+Always measures the in-process n-gram index (build time and query time)
+against a linear scan of the same strings. With --database it also loads
+the users into the benchmark database and compares the original
+`username LIKE '%q%'` query with `UserSearch`, which uses pg_trgm
+trigram indexes when the server has the extension.
+
+    python -m benchmarks.user_search --users 1000000 --database
+"""
+
+import argparse
+import time
+from random import choice, randint, seed
+
+from benchmarks.helpers import db, reset_db, bulk_insert, timed, report
+from models import User
+from search import NgramIndex, UserSearch, install_trigram_indexes, rank_key
+
+SYLLABLES = [
+    "ka", "lo", "mi", "ra", "te", "su", "no", "vi", "bel", "dor", "fin",
+    "gar", "hal", "jun", "kel", "mar", "nor", "pel", "quin", "ros", "sol",
+    "tam", "ul", "ven", "wil", "xan", "yor", "zed",
+]
+WORDS = [
+    "bird", "song", "morning", "forest", "river", "coffee", "music",
+    "travel", "photos", "code", "garden", "books", "running", "city",
+    "ocean", "mountain", "night", "owl", "warbler", "sparrow",
+]
+TERMS = ["kalo", "Warbler", "zed", "mi", "river", "nomatchatall"]
+
+
+def fake_profiles(count):
+    """Return `count` deterministic (id, username, bio) tuples."""
+
+    seed(0)
+    return [
+        (user_id,
+         "".join(choice(SYLLABLES) for _ in range(randint(2, 4)))
+         + str(user_id),
+         " ".join(choice(WORDS) for _ in range(randint(3, 8))).capitalize())
+        for user_id in range(1, count + 1)
+    ]
+
+
+def linear_scan(profiles, term, limit=100):
+    term = term.lower()
+    ranked = []
+    for user_id, username, bio in profiles:
+        key = rank_key(term, username, bio)
+        if key is not None:
+            ranked.append((key, user_id))
+    ranked.sort()
+    return [user_id for _, user_id in ranked[:limit]]
+
+
+def benchmark_in_process(profiles):
+    start = time.perf_counter()
+    index = NgramIndex()
+    for profile in profiles:
+        index.add(*profile)
+    report(f"n-gram index: build ({len(profiles):,} users)",
+           time.perf_counter() - start)
+
+    lowered = [(i, u.lower(), b.lower()) for i, u, b in profiles]
+    for term in TERMS:
+        assert index.search(term) == linear_scan(lowered, term), term
+        report(f"n-gram index: search {term!r}",
+               timed(lambda: index.search(term)))
+        report(f"linear scan: search {term!r}",
+               timed(lambda: linear_scan(lowered, term), repeat=3))
+
+
+def benchmark_database(profiles):
+    reset_db()
+    bulk_insert(User, [
+        dict(id=user_id, username=username, bio=bio,
+             email=f"user{user_id}@example.com", password="not-a-hash")
+        for user_id, username, bio in profiles
+    ], batch_size=50_000)
+
+    trigrams = install_trigram_indexes()
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE users"))
+    db.session.commit()
+
+    search = UserSearch()
+    if not search.uses_database():
+        print("pg_trgm unavailable: UserSearch falls back to the n-gram "
+              "index (first search includes loading it)")
+
+    for term in TERMS:
+        report(f"LIKE '%q%' (original): {term!r}",
+               timed(lambda: (User
+                              .query
+                              .filter(User.username.like(f"%{term}%"))
+                              .all()),
+                     repeat=3))
+        label = "trigram index" if trigrams else "UserSearch"
+        report(f"{label}: {term!r}",
+               timed(lambda: search.search(term), repeat=3))
+        db.session.expunge_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--database', action='store_true')
+    args = parser.parse_args()
+
+    profiles = fake_profiles(args.users)
+    benchmark_in_process(profiles)
+
+    if args.database:
+        print()
+        benchmark_database(profiles)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Lazy, cached resolution of the logged-in user (`g.user`).
+
+Most requests only need the logged-in user's id and what the nav bar
+shows. `CurrentUser` answers those from a per-process snapshot cache and
+only loads the User row (without password hash and bio, which are
+deferred) when something else is asked of it.
+
+Snapshots are keyed by (user id, profile version). The session records
+the profile version the browser last saw, so after a profile edit that
+browser misses the cache in every worker; other sessions of the same
+user pick up the edit when their snapshot's TTL runs out, and then
+record the new version, so they hit the cache again.
+"""
+
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+from sqlalchemy.orm import defer
+
+from models import User
+
+UserSnapshot = namedtuple(
+    'UserSnapshot',
+    ['id', 'username', 'image_url', 'header_image_url', 'profile_version'])
+
+
+class UserDeleted(Exception):
+    """The logged-in user's row is gone, though a snapshot of it was not
+    (the user was deleted by another process)."""
+
+    def __init__(self, user_id):
+        super().__init__(user_id)
+        self.user_id = user_id
+
+
+def load_user(user_id):
+    """Load a User for the current request, password and bio deferred."""
+
+    return (User
+            .query
+            .options(defer(User.password), defer(User.bio))
+            .get(user_id))
+
+
+class UserSnapshotCache:
+    """Bounded cache of `UserSnapshot`s that expire after `ttl` seconds."""
+
+    def __init__(self, ttl=60, max_entries=10_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id, profile_version):
+        """Return the cached snapshot, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get((user_id, profile_version))
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user):
+        """Cache and return a snapshot of `user` (a User)."""
+
+        snapshot = UserSnapshot(
+            user.id, user.username, user.image_url, user.header_image_url,
+            user.profile_version)
+        key = (user.id, user.profile_version)
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return snapshot
+
+    def invalidate(self, user_id):
+        """Drop every snapshot of `user_id`."""
+
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CurrentUser:
+    """Stands in for the logged-in User for the length of a request.
+
+    Snapshot attributes are served without a query until the User has
+    been loaded; anything else (counters, relationships, methods) loads it
+    and is delegated to it, as are all assignments. Code that needs the
+    instance itself, e.g. to delete it, uses `model`.
+    """
+
+    __slots__ = ('_snapshot', '_model')
+
+    def __init__(self, snapshot, model=None):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_model', model)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._snapshot.id}>"
+
+    @property
+    def model(self):
+        """The User, loaded on first use.
+
+        Raises `UserDeleted` if it has been deleted since it was cached.
+        """
+
+        if self._model is None:
+            model = load_user(self._snapshot.id)
+            if model is None:
+                raise UserDeleted(self._snapshot.id)
+            object.__setattr__(self, '_model', model)
+
+        return self._model
+
+    def __getattr__(self, name):
+        if self._model is None and name in UserSnapshot._fields:
+            return getattr(self._snapshot, name)
+
+        return getattr(self.model, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.model, name, value)
+
+
+def resolve_current_user(cache, user_id, profile_version):
+    """Return a `CurrentUser` for `user_id`, or None if there's no such user.
+
+    A cache miss loads the User right away (one query either way), so it
+    is at hand for the rest of the request. Either way, the result's
+    `profile_version` is the one to look the user up by next time.
+    """
+
+    if user_id is None:
+        return None
+
+    snapshot = cache.get(user_id, profile_version)
+    if snapshot is not None:
+        return CurrentUser(snapshot)
+
+    model = load_user(user_id)
+    if model is None:
+        return None
+
+    return CurrentUser(cache.put(model), model)
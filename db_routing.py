@@ -0,0 +1,53 @@
+"""Send reads to read replicas and writes to the primary database.
+
+Replicas are Flask-SQLAlchemy binds (SQLALCHEMY_BINDS) named in
+SQLALCHEMY_REPLICA_BINDS. A `RoutingSession` only reads from one while
+its `info['use_replica']` flag is set; app.py sets it for GET and HEAD
+requests. Everything else, including CLI commands and tests, uses the
+primary as before.
+
+Replicas lag the primary, so a session that writes switches to the
+primary for the rest of its life: a request reads its own writes. The
+app keeps a browser on the primary for a few seconds after a request
+that wrote (see `route_reads` in app.py), so it also sees its own writes
+on the pages it goes to next.
+
+Writes are recognized as flushes and INSERT / UPDATE / DELETE statements.
+Raw SQL run with `text()` is taken for a read: a GET handler that writes
+that way must clear `use_replica` first.
+"""
+
+import random
+
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from a replica while `info['use_replica']` is set.
+
+    Sets `info['wrote']` once it has sent a write to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+            self.info['use_replica'] = False
+
+        replicas = self.app.config.get('SQLALCHEMY_REPLICA_BINDS')
+        if replicas and self.info.get('use_replica'):
+            # One replica per session, so a request sees one snapshot.
+            if 'replica' not in self.info:
+                self.info['replica'] = random.choice(replicas)
+            return get_state(self.app).db.get_engine(
+                self.app, bind=self.info['replica'])
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """`SQLAlchemy` whose sessions are `RoutingSession`s."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
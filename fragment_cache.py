@@ -0,0 +1,94 @@
+"""LRU cache of rendered HTML fragments for message list items."""
+
+from collections import OrderedDict
+from threading import Lock
+
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """Bounded LRU cache of rendered message <li> fragments.
+
+    Entries are keyed by (message id, author profile version, like state).
+    Nothing viewer-specific goes in the key beyond the like state
+    ("own", "liked" or "unliked"), so one rendered fragment is shared by
+    every viewer who sees the message in the same state.
+
+    Because the author's profile version is part of the key, a profile
+    edit makes old fragments unreachable even in other worker processes;
+    `invalidate_author` and `invalidate_message` also drop them eagerly
+    from this process so they don't hold LRU slots.
+    """
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._keys_by_message = {}
+        self._keys_by_author = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_render(self, key, author_id, render):
+        """Return the fragment for `key`, calling `render()` on a miss."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        html = Markup(render())
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (author_id, html)
+            self._keys_by_message.setdefault(key[0], set()).add(key)
+            self._keys_by_author.setdefault(author_id, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                oldest, (oldest_author_id, _) = self._entries.popitem(
+                    last=False)
+                self._unindex(self._keys_by_message, oldest[0], oldest)
+                self._unindex(self._keys_by_author, oldest_author_id, oldest)
+
+        return html
+
+    def invalidate_message(self, message_id):
+        """Drop every fragment of a message (e.g. once it is deleted)."""
+
+        with self._lock:
+            for key in self._keys_by_message.pop(message_id, set()):
+                author_id, _ = self._entries.pop(key)
+                self._unindex(self._keys_by_author, author_id, key)
+
+    def invalidate_author(self, author_id):
+        """Drop every fragment showing an author's name or image."""
+
+        with self._lock:
+            for key in self._keys_by_author.pop(author_id, set()):
+                self._entries.pop(key)
+                self._unindex(self._keys_by_message, key[0], key)
+
+    def clear(self):
+        """Drop everything."""
+
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_message.clear()
+            self._keys_by_author.clear()
+
+    @staticmethod
+    def _unindex(index, index_key, key):
+        """Remove `key` from the set stored under `index_key`."""
+
+        keys = index.get(index_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[index_key]
@@ -0,0 +1,9 @@
+"""gunicorn settings, read from the working directory by `gunicorn app:app`."""
+
+
+def post_worker_init(worker):
+    """Warm up each worker's in-process indexes before it takes requests."""
+
+    from app import warm_up
+
+    warm_up()
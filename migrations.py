@@ -0,0 +1,119 @@
+"""Versioned schema changes for databases that already exist.
+
+`db.create_all()` makes missing tables, with the indexes declared in
+models.py, but never touches a table that is already there. Changes to
+existing tables go here instead, as numbered migrations that `upgrade`
+runs once each, in order, recording them in `schema_migrations`:
+
+    flask migrate
+
+Migrations are plain SQL, frozen once released, and written to be safe on
+a database that already has the change (as one made by `create_all`
+does). Indexes are built CONCURRENTLY, so the tables stay writable while
+they build; each statement therefore runs in its own transaction. A
+concurrent build that fails leaves an invalid index behind, which IF NOT
+EXISTS would then skip: drop it before running `upgrade` again.
+
+New tables start out empty. After the first `upgrade` of a database from
+before home timelines, also run `flask rebuild-timelines`.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import text
+
+from models import db
+
+Migration = namedtuple('Migration', ['version', 'description', 'statements'])
+
+MIGRATIONS = [
+    Migration(1, "Versions and denormalized counts on users", [
+        # With a constant default these are catalog-only changes: no
+        # table rewrite, however many users there are.
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS profile_version integer NOT NULL DEFAULT 0, "
+        "ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 0, "
+        "ADD COLUMN IF NOT EXISTS messages_count integer NOT NULL DEFAULT 0, "
+        "ADD COLUMN IF NOT EXISTS followers_count integer NOT NULL DEFAULT 0, "
+        "ADD COLUMN IF NOT EXISTS following_count integer NOT NULL DEFAULT 0, "
+        "ADD COLUMN IF NOT EXISTS likes_count integer NOT NULL DEFAULT 0",
+        # Fill in the counts, as `User.recount()` (flask recount-users).
+        "UPDATE users SET "
+        "messages_count = (SELECT count(*) FROM messages "
+        "                  WHERE messages.user_id = users.id), "
+        "followers_count = (SELECT count(*) FROM follows "
+        "                   WHERE follows.user_being_followed_id = users.id), "
+        "following_count = (SELECT count(*) FROM follows "
+        "                   WHERE follows.user_following_id = users.id), "
+        "likes_count = (SELECT count(*) FROM likes "
+        "               WHERE likes.user_liking_message_id = users.id)",
+    ]),
+    Migration(2, "Indexes for the timeline, profile and likes pages", [
+        # Who a user follows: home timeline, following page, follow checks.
+        # (The primary key, followed id first, serves the followers page.)
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+        "ix_follows_following_followed "
+        "ON follows (user_following_id, user_being_followed_id)",
+        # A user's messages, newest first: profile page, pulled timeline.
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+        "ix_messages_user_timestamp "
+        "ON messages (user_id, timestamp DESC, id DESC)",
+        # A user's home timeline, newest first.
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+        "ix_timeline_entries_owner_timestamp "
+        "ON timeline_entries (owner_id, timestamp DESC, message_id DESC)",
+        # Deleting a message (or a user, and so their messages) cascades
+        # to its timeline entries; without this each one is a full scan.
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+        "ix_timeline_entries_message ON timeline_entries (message_id)",
+        # What a user has liked. (The primary key, message id first,
+        # serves "who liked this message".)
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+        "ix_likes_user_message "
+        "ON likes (user_liking_message_id, message_being_liked_id)",
+    ]),
+]
+
+
+def applied_versions(connection):
+    """Return the set of migration versions already applied."""
+
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        " version integer PRIMARY KEY,"
+        " description text NOT NULL,"
+        " applied_at timestamp NOT NULL DEFAULT now())"))
+
+    return set(connection.execute(
+        text("SELECT version FROM schema_migrations")).scalars())
+
+
+def upgrade(migrations=MIGRATIONS):
+    """Create missing tables, then apply pending migrations in order.
+
+    Returns the migrations applied.
+    """
+
+    db.create_all()
+
+    applied = []
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level="AUTOCOMMIT")
+        done = applied_versions(connection)
+
+        for migration in sorted(migrations):
+            if migration.version in done:
+                continue
+
+            for statement in migration.statements:
+                connection.execute(text(statement))
+
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, description) "
+                     "VALUES (:version, :description)"),
+                {"version": migration.version,
+                 "description": migration.description})
+            applied.append(migration)
+
+    return applied
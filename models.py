@@ -2,11 +2,14 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exists, func, literal, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from db_routing import RoutingSQLAlchemy
+from password_hashing import HashingUnavailable, PasswordHasher
+
+password_hasher = PasswordHasher()
+db = RoutingSQLAlchemy()
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
@@ -30,6 +33,13 @@ class Follows(db.Model):
     )
 
 
+db.Index(
+    'ix_follows_following_followed',
+    Follows.user_following_id,
+    Follows.user_being_followed_id,
+)
+
+
 class LikedMessage(db.Model):
     """Connection of a user <-> liked_message."""
 
@@ -47,6 +57,14 @@ class LikedMessage(db.Model):
         primary_key=True,
     )
 
+
+db.Index(
+    'ix_likes_user_message',
+    LikedMessage.user_liking_message_id,
+    LikedMessage.message_being_liked_id,
+)
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -92,7 +110,58 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref="user")
+    # Bumped whenever the username or images change; part of the key of
+    # cached message fragments that show them (see fragment_cache.py).
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped by every write that changes what this user's pages show:
+    # profile edits and anything that moves one of the counters below.
+    # Used to build HTTP validators (ETags) for those pages.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Denormalized counts of the relationships below, kept in step by the
+    # write routes through `bump()` so pages never load a collection just
+    # to take its length. `recount()` repairs any drift.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    messages = db.relationship('Message', back_populates="user")
 
     followers = db.relationship(
         "User",
@@ -118,7 +187,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -140,30 +209,188 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        A hash made at a cost factor other than the configured one is
+        replaced with a fresh hash of `password` (commit to keep it); if
+        the hashing pool is busy, that waits for a later login.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    try:
+                        user.password = password_hasher.hash(password)
+                    except HashingUnavailable:
+                        pass
                 return user
 
         return False
 
+    @classmethod
+    def bump(cls, user_ids, **deltas):
+        """Add `deltas` to the counter columns of `user_ids`.
+
+        `user_ids` is a list of ids or a select of ids; e.g.
+        `User.bump([user.id], following_count=1)`. This runs as a single
+        UPDATE inside the caller's transaction, so counters commit or roll
+        back together with the change they count. It also advances each
+        user's `version`; call it with no deltas to do only that.
+        """
+
+        values = {
+            getattr(cls, name): getattr(cls, name) + delta
+            for name, delta in deltas.items()
+        }
+        values[cls.version] = cls.version + 1
+
+        (cls.query
+            .filter(cls.id.in_(user_ids))
+            .update(values, synchronize_session=False))
+
+    @classmethod
+    def recount(cls):
+        """Recompute every user's counters from the underlying tables."""
+
+        def count(table, owner_column):
+            return (select(func.count())
+                    .select_from(table)
+                    .where(owner_column == cls.id)
+                    .scalar_subquery())
+
+        (cls.query
+            .update({
+                cls.messages_count: count(
+                    Message.__table__, Message.user_id),
+                cls.followers_count: count(
+                    Follows.__table__, Follows.user_being_followed_id),
+                cls.following_count: count(
+                    Follows.__table__, Follows.user_following_id),
+                cls.likes_count: count(
+                    LikedMessage.__table__,
+                    LikedMessage.user_liking_message_id),
+            }, synchronize_session=False))
+
+    @classmethod
+    def followers_of(cls, user_id):
+        """Query the followers of user `user_id`, in id order."""
+
+        return (cls
+                .query
+                .join(Follows, Follows.user_following_id == cls.id)
+                .filter(Follows.user_being_followed_id == user_id)
+                .order_by(cls.id))
+
+    @classmethod
+    def followed_by(cls, user_id):
+        """Query the users followed by user `user_id`, in id order."""
+
+        return (cls
+                .query
+                .join(Follows, Follows.user_being_followed_id == cls.id)
+                .filter(Follows.user_following_id == user_id)
+                .order_by(cls.id))
+
+    def release_counts(self):
+        """Decrement other users' counters before this user is deleted.
+
+        Deleting a user cascades away their follows, their messages and the
+        likes on those messages; this keeps everybody else's counts right.
+        """
+
+        User.bump(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id),
+            followers_count=-1)
+        User.bump(
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == self.id),
+            following_count=-1)
+
+        likes_lost = (
+            select(
+                LikedMessage.user_liking_message_id.label('user_id'),
+                func.count().label('likes'))
+            .join(Message, Message.id == LikedMessage.message_being_liked_id)
+            .where(Message.user_id == self.id)
+            .group_by(LikedMessage.user_liking_message_id)
+            .subquery())
+
+        db.session.execute(
+            update(User)
+            .where(User.id == likes_lost.c.user_id)
+            .values(
+                likes_count=User.likes_count - likes_lost.c.likes,
+                version=User.version + 1)
+            .execution_options(synchronize_session=False))
+
+    def liked_ids_among(self, messages):
+        """Return the set of ids of `messages` this user has liked.
+
+        Resolves a whole page of messages in one query, so templates can
+        test `msg.id in liked_ids` instead of scanning `liked_messages`.
+        """
+
+        message_ids = [msg.id for msg in messages]
+        if not message_ids:
+            return set()
+
+        liked = db.session.execute(
+            select(LikedMessage.message_being_liked_id)
+            .where(LikedMessage.user_liking_message_id == self.id)
+            .where(LikedMessage.message_being_liked_id.in_(message_ids)))
+
+        return set(liked.scalars())
+
+    def following_ids_among(self, users):
+        """Return the set of ids of `users` this user is following.
+
+        Like `liked_ids_among`, resolves a whole page of users in one query.
+        """
+
+        user_ids = [user.id for user in users]
+        if not user_ids:
+            return set()
+
+        followed = db.session.execute(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id)
+            .where(Follows.user_being_followed_id.in_(user_ids)))
+
+        return set(followed.scalars())
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?
+
+        Answered by an indexed EXISTS on follows rather than loading the
+        `following` collection. Answers are memoized on this instance,
+        which lives for one request (sessions are request-scoped), and
+        forgotten when this user's follows change.
+        """
+
+        memo = vars(self).setdefault('_following_memo', {})
+
+        if other_user.id not in memo:
+            memo[other_user.id] = db.session.query(exists().where(
+                Follows.user_following_id == self.id,
+                Follows.user_being_followed_id == other_user.id)).scalar()
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return memo[other_user.id]
+
+
+@event.listens_for(User.followers, 'append')
+@event.listens_for(User.followers, 'remove')
+def forget_follow_checks(followed_user, follower, initiator):
+    """Clear the `is_following` memo when a follow is added or removed."""
+
+    vars(follower).pop('_following_memo', None)
 
 
 
@@ -195,6 +422,286 @@ class Message(db.Model):
         nullable=False,
     )
 
+    user = db.relationship('User', back_populates="messages")
+
+    @classmethod
+    def with_authors(cls):
+        """Query messages with their authors eagerly loaded.
+
+        Every page that renders `msg.user` for a list of messages should
+        start from this query: the author rows come back in the same
+        SELECT (a join on the many-to-one), so a page costs one query
+        instead of one per message.
+        """
+
+        return cls.query.options(db.joinedload(cls.user))
+
+    @classmethod
+    def in_timeline_of(cls, user_id):
+        """SQL criterion for messages in `user_id`'s fan-in home timeline.
+
+        Matches messages by the user and everyone they follow. The followed
+        ids come from a subquery on `follows`, so no follow rows or User
+        objects are loaded into Python to build it.
+        """
+
+        timeline_user_ids = (
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id)
+            .union_all(select(literal(user_id))))
+
+        return cls.user_id.in_(timeline_user_ids)
+
+    @classmethod
+    def timeline_for(cls, user_id):
+        """Query `user_id`'s fan-in home timeline as one statement."""
+
+        return (cls
+                .with_authors()
+                .filter(cls.in_timeline_of(user_id))
+                .order_by(cls.timestamp.desc(), cls.id.desc()))
+
+    @classmethod
+    def liked_by(cls, user_id):
+        """Query messages liked by `user_id`, newest first, with authors."""
+
+        return (cls
+                .with_authors()
+                .join(
+                    LikedMessage,
+                    LikedMessage.message_being_liked_id == cls.id)
+                .filter(LikedMessage.user_liking_message_id == user_id)
+                .order_by(cls.timestamp.desc(), cls.id.desc()))
+
+
+db.Index(
+    'ix_messages_user_timestamp',
+    Message.user_id,
+    Message.timestamp.desc(),
+    Message.id.desc(),
+)
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Timelines are filled on write: posting a message copies a row into the
+    author's and every follower's timeline, so reading the home page is a
+    single indexed lookup on `owner_id` instead of an IN query over
+    everybody the user follows.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    COLUMNS = ['owner_id', 'message_id', 'author_id', 'timestamp']
+
+    @classmethod
+    def fan_out(cls, message, to_followers=True):
+        """Deliver a (flushed) `message` to its author and their followers.
+
+        With `to_followers=False` only the author's own timeline gets it;
+        readers then have to pull the message in (see timeline.py).
+        """
+
+        recipients = select(
+            literal(message.user_id),
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp))
+
+        if to_followers:
+            recipients = recipients.union_all(
+                select(
+                    Follows.user_following_id,
+                    literal(message.id),
+                    literal(message.user_id),
+                    literal(message.timestamp))
+                .where(Follows.user_being_followed_id == message.user_id))
+
+        db.session.execute(
+            insert(cls)
+            .from_select(cls.COLUMNS, recipients)
+            .on_conflict_do_nothing())
+
+    @classmethod
+    def backfill(cls, owner_id, author_id):
+        """Copy every message by `author_id` into `owner_id`'s timeline.
+
+        Called when `owner_id` starts following `author_id`.
+        """
+
+        messages = (
+            select(
+                literal(owner_id),
+                Message.id,
+                Message.user_id,
+                Message.timestamp)
+            .where(Message.user_id == author_id))
+
+        db.session.execute(
+            insert(cls)
+            .from_select(cls.COLUMNS, messages)
+            .on_conflict_do_nothing())
+
+    @classmethod
+    def prune(cls, owner_id, author_id):
+        """Remove messages by `author_id` from `owner_id`'s timeline.
+
+        Called when `owner_id` stops following `author_id`.
+        """
+
+        (cls.query
+            .filter_by(owner_id=owner_id, author_id=author_id)
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, owner_id=None):
+        """Recompute timelines from the messages and follows tables.
+
+        Rebuilds one user's timeline when `owner_id` is given, otherwise
+        everybody's. Use after bulk loads (see seed.py) that bypass
+        `fan_out`.
+        """
+
+        if owner_id is not None:
+            messages = (
+                select(
+                    literal(owner_id),
+                    Message.id,
+                    Message.user_id,
+                    Message.timestamp)
+                .where(Message.in_timeline_of(owner_id)))
+
+            cls.query.filter_by(owner_id=owner_id).delete(
+                synchronize_session=False)
+            db.session.execute(
+                insert(cls)
+                .from_select(cls.COLUMNS, messages)
+                .on_conflict_do_nothing())
+            return
+
+        followed = (
+            select(
+                Follows.user_following_id,
+                Message.id,
+                Message.user_id,
+                Message.timestamp)
+            .join(Follows, Follows.user_being_followed_id == Message.user_id))
+        own = select(
+            Message.user_id,
+            Message.id,
+            Message.user_id,
+            Message.timestamp)
+
+        cls.query.delete(synchronize_session=False)
+        db.session.execute(
+            insert(cls)
+            .from_select(cls.COLUMNS, followed.union_all(own))
+            .on_conflict_do_nothing())
+
+    @classmethod
+    def messages_for(cls, owner_id, limit=100, before=None):
+        """Return the `limit` most recent messages in a user's timeline.
+
+        `before` is an optional (timestamp, message_id) keyset cursor; only
+        messages strictly older than it are returned, so every page costs
+        one index range scan no matter how deep the user has scrolled.
+        """
+
+        query = (Message
+                 .with_authors()
+                 .join(cls, cls.message_id == Message.id)
+                 .filter(cls.owner_id == owner_id))
+
+        if before:
+            query = query.filter(
+                tuple_(cls.timestamp, cls.message_id) < tuple_(*before))
+
+        return (query
+                .order_by(cls.timestamp.desc(), cls.message_id.desc())
+                .limit(limit)
+                .all())
+
+
+db.Index(
+    'ix_timeline_entries_owner_timestamp',
+    TimelineEntry.owner_id,
+    TimelineEntry.timestamp.desc(),
+    TimelineEntry.message_id.desc(),
+)
+
+# For the cascade when a message is deleted.
+db.Index('ix_timeline_entries_message', TimelineEntry.message_id)
+
+
+class Recommendation(db.Model):
+    """A suggested account for a user to follow, with its score.
+
+    Computed in batch over the whole follows graph (see recommendations.py)
+    and replaced wholesale on every refresh.
+    """
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    recommended_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    @classmethod
+    def users_for(cls, user_id, limit=5):
+        """Return up to `limit` recommended Users for `user_id`, best first.
+
+        Skips anyone `user_id` has followed since the last refresh.
+        """
+
+        followed = (select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == user_id))
+
+        return (User
+                .query
+                .join(cls, cls.recommended_id == User.id)
+                .filter(cls.user_id == user_id)
+                .filter(User.id.not_in(followed))
+                .order_by(cls.score.desc(), User.id)
+                .limit(limit)
+                .all())
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -204,3 +711,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    password_hasher.init_app(app)
@@ -0,0 +1,215 @@
+"""Password hashing in a bounded process pool.
+
+bcrypt is deliberately slow and CPU-bound. Run inline, a burst of logins
+or signups keeps every web worker's CPU busy hashing, and everything else
+queues behind them. `PasswordHasher` runs hashes in a small pool of
+worker processes instead, so at most `workers` hashes run at a time per
+web process, and it refuses work rather than letting it pile up: when
+`max_pending` hashes are already queued or running, or one takes longer
+than `timeout` seconds, it raises `HashingUnavailable`.
+
+Settings come from the app config (see `init_app`), so the bcrypt cost
+factor and pool size can be set per environment. `calibrate` picks a cost
+factor for the host (`flask calibrate-password-hashing`), and hashes made
+at another cost are upgraded at the user's next login (see
+`User.authenticate`).
+"""
+
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+
+class HashingUnavailable(Exception):
+    """Too many passwords are being hashed right now; try again later."""
+
+
+def hash_password(password, rounds):
+    """Return the bcrypt hash of `password` at cost factor `rounds`."""
+
+    return bcrypt.hashpw(
+        password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def check_password(password_hash, password):
+    """Does `password` match bcrypt hash `password_hash`?"""
+
+    return bcrypt.checkpw(
+        password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+def hash_rounds(password_hash):
+    """Return the cost factor a bcrypt hash was made with.
+
+    >>> hash_rounds(hash_password('secret', 4))
+    4
+    """
+
+    return int(password_hash.split('$')[2])
+
+
+def calibrate(target_ms, min_rounds=4, max_rounds=16, samples=3):
+    """Find the bcrypt cost factor whose hashes take about `target_ms` here.
+
+    Times `samples` hashes at each cost from `min_rounds` up, stopping
+    past the target (each step doubles the time). Returns (rounds,
+    timings): the highest cost whose median time is within the target
+    (at least `min_rounds`), and a {rounds: median ms} dict.
+    """
+
+    timings = {}
+    chosen = min_rounds
+
+    for rounds in range(min_rounds, max_rounds + 1):
+        times = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            hash_password("calibration password", rounds)
+            times.append((time.perf_counter() - start) * 1000)
+
+        timings[rounds] = statistics.median(times)
+        if timings[rounds] > target_ms:
+            break
+        chosen = rounds
+
+    return chosen, timings
+
+
+class PasswordHasher:
+    """Hashes and checks passwords in a bounded pool of processes.
+
+    With `workers=0` hashing runs inline, in the calling thread, but still
+    counts against `max_pending`.
+    """
+
+    def __init__(self, rounds=12, workers=2, max_pending=8, timeout=5.0):
+        self.configure(rounds, workers, max_pending, timeout)
+
+        self._executor = None
+        self._executor_pid = None
+        self._lock = Lock()
+        self.reset_stats()
+
+    def init_app(self, app):
+        """Configure from PASSWORD_HASH_* settings in `app.config`."""
+
+        config = app.config
+        self.configure(
+            rounds=config.setdefault('PASSWORD_HASH_ROUNDS', 12),
+            workers=config.setdefault('PASSWORD_HASH_WORKERS', 2),
+            max_pending=config.setdefault('PASSWORD_HASH_MAX_PENDING', 8),
+            timeout=config.setdefault('PASSWORD_HASH_TIMEOUT', 5.0))
+
+    def configure(self, rounds, workers, max_pending, timeout):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(max_pending)
+        self._pending = 0
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password`."""
+
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, password_hash, password):
+        """Does `password` match `password_hash`?"""
+
+        return self._run(check_password, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Was `password_hash` made at a cost other than `rounds`?"""
+
+        return hash_rounds(password_hash) != self.rounds
+
+    def stats(self):
+        """Return queue depth and hash latency figures, for /_metrics."""
+
+        with self._lock:
+            completed = self._completed
+            return {
+                "rounds": self.rounds,
+                "workers": self.workers,
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "completed": completed,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "avg_ms": (round(self._total_seconds / completed * 1000, 2)
+                           if completed else None),
+                "max_ms": round(self._max_seconds * 1000, 2),
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._completed = 0
+            self._rejected = 0
+            self._timed_out = 0
+            self._total_seconds = 0.0
+            self._max_seconds = 0.0
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HashingUnavailable()
+
+        with self._lock:
+            self._pending += 1
+        start = time.perf_counter()
+
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                self._finished(start)
+
+        # The slot is given back when the hash finishes, not when we stop
+        # waiting for it, so abandoned hashes still count as pending.
+        try:
+            future = self._pool().submit(fn, *args)
+        except Exception:
+            self._finished(start)
+            raise
+        future.add_done_callback(lambda _: self._finished(start))
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self._timed_out += 1
+            raise HashingUnavailable()
+
+    def _finished(self, start):
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._pending -= 1
+            self._completed += 1
+            self._total_seconds += elapsed
+            self._max_seconds = max(self._max_seconds, elapsed)
+        self._slots.release()
+
+    def _pool(self):
+        # A pool made before a fork (e.g. gunicorn --preload) belongs to
+        # the parent; each process gets its own.
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+                self._executor_pid = os.getpid()
+
+            return self._executor
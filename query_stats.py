@@ -0,0 +1,238 @@
+"""Per-request SQL query instrumentation.
+
+Hooks SQLAlchemy engine events to count queries and time them, per Flask
+request and aggregated per endpoint. Outside production the numbers are
+also sent back as response headers:
+
+    X-DB-Query-Count: 4
+    X-DB-Time-Ms: 3.12
+    X-DB-Slowest-Ms: 1.87
+
+`query_budget` is a test helper that fails when a block of code (such as
+a test client request) runs more queries than it is allowed, and
+`recorded_executions` plus `explain` let tests check the query plans of
+what a block of code runs.
+"""
+
+import heapq
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestQueries:
+    """Queries run while handling one request."""
+
+    def __init__(self, keep_slowest):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []
+        self._keep_slowest = keep_slowest
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+
+        entry = (seconds, statement)
+        if len(self.slowest) < self._keep_slowest:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+
+class QueryStats:
+    """Collects query counts and timings per request and per endpoint.
+
+    Usage: `QueryStats(app)`. Headers are sent when the QUERY_STATS_HEADERS
+    config is true; it defaults to on in debug, testing and non-production
+    environments.
+    """
+
+    def __init__(self, app=None, keep_slowest=5):
+        self.keep_slowest = keep_slowest
+        self._endpoints = {}
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_STATS_HEADERS', None)
+
+        event.listen(Engine, "before_cursor_execute", self._before_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_execute)
+        event.listen(Engine, "handle_error", self._execute_failed)
+        # Start counting ahead of every other before_request hook, so the
+        # queries they run (e.g. loading g.user) are counted too.
+        app.before_request_funcs.setdefault(None, []).insert(
+            0, self._start_request)
+        app.after_request(self._finish_request)
+
+        self.app = app
+
+    def headers_enabled(self):
+        enabled = self.app.config['QUERY_STATS_HEADERS']
+        if enabled is None:
+            return (self.app.debug
+                    or self.app.testing
+                    or self.app.env != 'production')
+        return enabled
+
+    def report(self):
+        """Return per-endpoint totals, busiest endpoint first."""
+
+        with self._lock:
+            endpoints = [
+                dict(
+                    endpoint=endpoint,
+                    requests=totals['requests'],
+                    queries=totals['queries'],
+                    queries_per_request=(
+                        totals['queries'] / totals['requests']),
+                    db_ms=round(totals['seconds'] * 1000, 2),
+                    slowest=[
+                        dict(ms=round(seconds * 1000, 2), statement=stmt)
+                        for seconds, stmt in sorted(
+                            totals['slowest'], reverse=True)
+                    ],
+                )
+                for endpoint, totals in self._endpoints.items()
+            ]
+
+        return sorted(endpoints, key=lambda e: e['db_ms'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def _start_request(self):
+        g._request_queries = RequestQueries(self.keep_slowest)
+
+    def _finish_request(self, response):
+        queries = g.pop('_request_queries', None)
+        if queries is None:
+            return response
+
+        with self._lock:
+            totals = self._endpoints.setdefault(
+                request.endpoint,
+                dict(requests=0, queries=0, seconds=0.0, slowest=[]))
+            totals['requests'] += 1
+            totals['queries'] += queries.count
+            totals['seconds'] += queries.seconds
+            totals['slowest'] = heapq.nlargest(
+                self.keep_slowest, totals['slowest'] + queries.slowest)
+
+        if self.headers_enabled():
+            slowest = max(queries.slowest, default=(0.0, None))[0]
+            response.headers['X-DB-Query-Count'] = str(queries.count)
+            response.headers['X-DB-Time-Ms'] = f"{queries.seconds * 1000:.2f}"
+            response.headers['X-DB-Slowest-Ms'] = f"{slowest * 1000:.2f}"
+
+        return response
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault('query_start_times', []).append(
+            (context, time.perf_counter()))
+
+    @staticmethod
+    def _after_execute(conn, cursor, statement, parameters, context,
+                       executemany):
+        _, started = conn.info['query_start_times'].pop()
+        seconds = time.perf_counter() - started
+
+        if has_request_context():
+            queries = g.get('_request_queries')
+            if queries is not None:
+                queries.add(statement, seconds)
+
+    @staticmethod
+    def _execute_failed(exception_context):
+        # A statement that raises never reaches after_cursor_execute; drop
+        # its start time (if it got as far as taking one), or the
+        # connection, back in the pool, would pair every later statement
+        # with an earlier one's start.
+        conn = exception_context.connection
+        context = exception_context.execution_context
+        if conn is None or context is None:
+            return
+
+        start_times = conn.info.get('query_start_times')
+        if start_times and start_times[-1][0] is context:
+            start_times.pop()
+
+
+@contextmanager
+def recorded_queries():
+    """Collect the SQL statements executed inside the block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+
+@contextmanager
+def recorded_executions():
+    """Collect (statement, parameters) for each query run inside the block."""
+
+    executions = []
+
+    def record(conn, cursor, statement, parameters, *args):
+        executions.append((statement, parameters))
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        yield executions
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+
+def explain(connection, statement, parameters=None):
+    """Return Postgres's plan for a statement, as from `recorded_executions`.
+
+    The plan is the top plan node of EXPLAIN (FORMAT JSON): a dict with
+    "Node Type", "Relation Name", "Index Name", "Plans" (its children)
+    and so on.
+    """
+
+    result = connection.exec_driver_sql(
+        f"EXPLAIN (FORMAT JSON) {statement}", parameters or {})
+    return result.scalar()[0]['Plan']
+
+
+def plan_nodes(plan):
+    """Yield every node of a plan from `explain`, depth first."""
+
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+@contextmanager
+def query_budget(limit):
+    """Fail with AssertionError if the block runs more than `limit` queries.
+
+        with query_budget(6):
+            client.get("/")
+    """
+
+    with recorded_queries() as statements:
+        yield statements
+
+    if len(statements) > limit:
+        raise AssertionError(
+            f"{len(statements)} queries run, budget was {limit}:\n"
+            + "\n".join(statements))
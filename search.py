@@ -0,0 +1,435 @@
+"""Case-insensitive, ranked user search over username and bio.
+
+On Postgres with the pg_trgm extension, `install_trigram_indexes()` adds
+GIN trigram indexes on users.username and users.bio, and searches run as
+ILIKE queries those indexes can answer (a leading-wildcard LIKE can't use
+a B-tree index, so without them every search is a sequential scan).
+
+Where pg_trgm isn't available, `UserSearch` keeps an in-process n-gram
+inverted index of the same columns instead.
+
+Username autocomplete is always served in-process, from a sorted array of
+usernames (`UsernamePrefixIndex`), without touching the database.
+
+Results are ranked: exact username, then username prefix, then username
+substring, then bio matches; shorter usernames first within each group.
+"""
+
+import heapq
+import time
+from array import array
+from bisect import bisect_left, insort
+from threading import Lock, Thread
+
+from sqlalchemy import case, func, or_, select, text
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User
+
+TRIGRAM_INDEXES = {
+    'ix_users_username_trgm': 'username',
+    'ix_users_bio_trgm': 'bio',
+}
+
+
+def install_trigram_indexes():
+    """Create pg_trgm and the users trigram indexes, if possible.
+
+    Returns False (changing nothing) when the extension is unavailable.
+    """
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError:
+        return False
+
+    for name, column in TRIGRAM_INDEXES.items():
+        db.session.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {name} "
+            f"ON users USING gin ({column} gin_trgm_ops)"))
+
+    return True
+
+
+def has_trigram_indexes():
+    """Are the trigram indexes from `install_trigram_indexes` in place?"""
+
+    found = db.session.execute(
+        text("SELECT count(*) FROM pg_indexes WHERE indexname IN :names")
+        .bindparams(names=tuple(TRIGRAM_INDEXES))).scalar()
+
+    return found == len(TRIGRAM_INDEXES)
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in a user-supplied search term."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def rank_key(term, username, bio):
+    """Sort key for a match of (already lowercased) `term`; None if none."""
+
+    if username == term:
+        group = 0
+    elif username.startswith(term):
+        group = 1
+    elif term in username:
+        group = 2
+    elif bio and term in bio:
+        group = 3
+    else:
+        return None
+
+    return (group, len(username), username)
+
+
+class NgramIndex:
+    """In-process n-gram inverted index over usernames and bios.
+
+    Usernames are indexed by every 1-, 2- and 3-gram, bios by 3-grams only
+    (so terms shorter than 3 characters match usernames only). A search
+    looks up the posting list of the rarest n-gram in the term and checks
+    each candidate with a real substring test.
+
+    Posting lists are append-only arrays of user ids. `add` on an existing
+    user and `remove` leave stale ids behind, which the substring check
+    against the current document filters out; building a fresh index
+    (see `UserSearch.refresh_seconds`) drops them.
+    """
+
+    GRAM_SIZE = 3
+
+    def __init__(self):
+        self._docs = {}
+        self._username_postings = {}
+        self._bio_postings = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    @classmethod
+    def grams(cls, value, sizes):
+        """Return the set of n-grams of `value` for each n in `sizes`."""
+
+        return {
+            value[start:start + n]
+            for n in sizes
+            for start in range(len(value) - n + 1)
+        }
+
+    def add(self, user_id, username, bio):
+        """Index (or re-index) a user."""
+
+        username = username.lower()
+        bio = (bio or '').lower()
+
+        with self._lock:
+            self._docs[user_id] = (username, bio)
+            self._post(self._username_postings, user_id,
+                       self.grams(username, range(1, self.GRAM_SIZE + 1)))
+            self._post(self._bio_postings, user_id,
+                       self.grams(bio, [self.GRAM_SIZE]))
+
+    @staticmethod
+    def _post(postings, user_id, grams):
+        for gram in grams:
+            ids = postings.get(gram)
+            if ids is None:
+                ids = postings[gram] = array('i')
+            ids.append(user_id)
+
+    def remove(self, user_id):
+        """Drop a user from search results."""
+
+        with self._lock:
+            self._docs.pop(user_id, None)
+
+    def search(self, term, limit=100):
+        """Return up to `limit` matching user ids, best match first.
+
+        Username matches always outrank bio matches, so bios are only
+        scanned when usernames alone don't fill `limit`.
+        """
+
+        term = term.strip().lower()
+        if not term:
+            return []
+
+        with self._lock:
+            found = self._ranked(self._username_postings, term, limit)
+            if len(found) < limit and len(term) >= self.GRAM_SIZE:
+                seen = {user_id for _, user_id in found}
+                found += self._ranked(
+                    self._bio_postings, term, limit - len(found), seen)
+
+        return [user_id for _, user_id in found]
+
+    def _ranked(self, postings, term, limit, skip=()):
+        size = min(len(term), self.GRAM_SIZE)
+        candidates = set(min(
+            (postings.get(gram, ()) for gram in self.grams(term, [size])),
+            key=len))
+
+        ranked = []
+        for user_id in candidates:
+            doc = self._docs.get(user_id)
+            if doc is None or user_id in skip:
+                continue
+            key = rank_key(term, *doc)
+            if key is not None:
+                ranked.append((key, user_id))
+
+        return heapq.nsmallest(limit, ranked)
+
+
+class UsernamePrefixIndex:
+    """Sorted array of lowercased usernames, for prefix lookups by bisect.
+
+    Keys are (lowercased username, user id), so users whose usernames
+    differ only in case sort together; completions come back in that
+    (alphabetical, shortest first) order.
+    """
+
+    def __init__(self, users=()):
+        self._usernames = {user_id: username for user_id, username in users}
+        self._keys = sorted(
+            (username.lower(), user_id)
+            for user_id, username in self._usernames.items())
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, user_id, username):
+        """Add a user, or update their username."""
+
+        with self._lock:
+            self._discard(user_id)
+            self._usernames[user_id] = username
+            insort(self._keys, (username.lower(), user_id))
+
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def complete(self, prefix, limit=10):
+        """Return up to `limit` (user id, username) whose username starts
+        with `prefix`, case-insensitively."""
+
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        with self._lock:
+            start = bisect_left(self._keys, (prefix,))
+            found = []
+            for key, user_id in self._keys[start:start + limit]:
+                if not key.startswith(prefix):
+                    break
+                found.append((user_id, self._usernames[user_id]))
+
+        return found
+
+    def _discard(self, user_id):
+        username = self._usernames.pop(user_id, None)
+        if username is not None:
+            key = (username.lower(), user_id)
+            position = bisect_left(self._keys, key)
+            del self._keys[position]
+
+
+class UserSearch:
+    """Searches users via trigram indexes, or an in-process n-gram index.
+
+    Which one is used is decided on first search, and checked again every
+    `refresh_seconds`, so `flask install-search-indexes` takes effect
+    without a restart. Also serves username autocomplete from a
+    `UsernamePrefixIndex`.
+
+    The in-process indexes are built on first use (`load_usernames`
+    builds the autocomplete one eagerly), kept current with
+    `user_changed` / `user_removed` for writes made by this process, and
+    rebuilt every `refresh_seconds` to pick up writes made by other
+    worker processes. Rebuilds after the first run in a background
+    thread, and searches keep using the old index until the new one is
+    swapped in. Changes this process makes while an index is being built
+    are replayed onto it before the swap.
+    """
+
+    def __init__(self, refresh_seconds=300):
+        self.refresh_seconds = refresh_seconds
+        self.index = None
+        self.usernames = None
+        self._use_database = None
+        self._loaded_at = {}
+        self._refreshing = set()
+        # Index name -> change lists of the builds of it in progress.
+        self._recording = {}
+        self._lock = Lock()
+
+    def uses_database(self):
+        if self._use_database is None or self._stale('use_database'):
+            self._use_database = has_trigram_indexes()
+            self._loaded_at['use_database'] = time.monotonic()
+        return self._use_database
+
+    def search(self, term, limit=100):
+        """Return up to `limit` users matching `term`, best match first."""
+
+        term = term.strip()
+        if not term:
+            return []
+
+        if self.uses_database():
+            return self._search_database(term, limit)
+
+        user_ids = self._fresh('index', build_ngram_index).search(term, limit)
+        users = {u.id: u for u in User.query.filter(User.id.in_(user_ids))}
+        return [users[user_id] for user_id in user_ids if user_id in users]
+
+    def autocomplete(self, prefix, limit=10):
+        """Return up to `limit` (user id, username) starting with `prefix`."""
+
+        return self._fresh('usernames', build_prefix_index).complete(
+            prefix, limit)
+
+    def load_usernames(self):
+        """(Re)load the autocomplete index from the database."""
+
+        self._rebuild('usernames', build_prefix_index)
+
+    def user_changed(self, user):
+        """Re-index a user created or edited by this process."""
+
+        self._apply('index', 'add', user.id, user.username, user.bio)
+        self._apply('usernames', 'add', user.id, user.username)
+
+    def user_removed(self, user_id):
+        """Drop a user deleted by this process."""
+
+        self._apply('index', 'remove', user_id)
+        self._apply('usernames', 'remove', user_id)
+
+    def _apply(self, name, method, *args):
+        """Call `method` on index `name`, and on any build of it in
+        progress (which may have read the user before the change)."""
+
+        with self._lock:
+            index = getattr(self, name)
+            if index is not None:
+                getattr(index, method)(*args)
+            for changes in self._recording.get(name, ()):
+                changes.append((method, args))
+
+    def _search_database(self, term, limit):
+        lowered = term.lower()
+        escaped = escape_like(lowered)
+        contains = f"%{escaped}%"
+
+        rank = case(
+            (func.lower(User.username) == lowered, 0),
+            (User.username.ilike(f"{escaped}%", escape='\\'), 1),
+            (User.username.ilike(contains, escape='\\'), 2),
+            else_=3)
+
+        return (User
+                .query
+                .filter(or_(
+                    User.username.ilike(contains, escape='\\'),
+                    User.bio.ilike(contains, escape='\\')))
+                .order_by(
+                    rank,
+                    func.similarity(User.username, lowered).desc(),
+                    func.length(User.username),
+                    User.username)
+                .limit(limit)
+                .all())
+
+    def _fresh(self, name, build):
+        """Return index `name` (an attribute), building it if missing and
+        starting a background rebuild if it is older than
+        `refresh_seconds`."""
+
+        index = getattr(self, name)
+        if index is None:
+            # Nothing to serve yet, so this request builds it.
+            index = self._rebuild(name, build)
+        elif self._stale(name):
+            self._rebuild_in_background(name, build)
+
+        return index
+
+    def _stale(self, name):
+        return (time.monotonic() - self._loaded_at.get(name, 0)
+                > self.refresh_seconds)
+
+    def _rebuild(self, name, build):
+        """Build index `name` afresh, replay the changes made meanwhile,
+        and swap it in. Returns the new index."""
+
+        changes = []
+        with self._lock:
+            self._recording.setdefault(name, []).append(changes)
+
+        try:
+            index = build()
+            # Replayed under the lock, so no change can slip in between
+            # the replay and the swap.
+            with self._lock:
+                for method, args in changes:
+                    getattr(index, method)(*args)
+                setattr(self, name, index)
+                self._loaded_at[name] = time.monotonic()
+        finally:
+            with self._lock:
+                self._recording[name].remove(changes)
+
+        return index
+
+    def _rebuild_in_background(self, name, build):
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        def rebuild():
+            try:
+                self._rebuild(name, build)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(name)
+
+        Thread(target=rebuild, name=f"user-search-{name}", daemon=True).start()
+
+
+def build_ngram_index():
+    """Build an `NgramIndex` of every user.
+
+    Reads on a connection of its own, not the request's session, so it
+    can run in a background thread.
+    """
+
+    index = NgramIndex()
+    with db.engine.connect() as connection:
+        rows = connection.execute(select(User.id, User.username, User.bio))
+        for user_id, username, bio in rows:
+            index.add(user_id, username, bio)
+
+    return index
+
+
+def build_prefix_index():
+    """Build a `UsernamePrefixIndex` of every user.
+
+    Like `build_ngram_index`, reads on a connection of its own.
+    """
+
+    with db.engine.connect() as connection:
+        return UsernamePrefixIndex(
+            connection.execute(select(User.id, User.username)))
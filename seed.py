@@ -2,7 +2,8 @@
 
 from csv import DictReader
 from app import db
-from models import User, Message, Follows, LikedMessage
+from models import User, Message, Follows, LikedMessage, TimelineEntry
+from search import install_trigram_indexes
 
 db.drop_all()
 db.create_all()
@@ -16,6 +17,10 @@ with open('generator/messages.csv') as messages:
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+User.recount()
+TimelineEntry.rebuild()
+install_trigram_indexes()
+
 db.session.commit()
 
 # test
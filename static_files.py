@@ -0,0 +1,183 @@
+"""Serve static/ from WSGI middleware, ahead of the Flask app.
+
+Requests for static files never reach Flask, so they run none of its
+request hooks (no session, no `g.user`, no CSRF form) and never touch the
+database. Everything about a file is worked out once, at startup: its
+bytes, content type, ETag and, for text formats, a gzip-compressed copy.
+
+Each file is served under two URLs:
+
+- its plain path, e.g. /static/stylesheets/style.css, cached for
+  `max_age` seconds and revalidated by ETag after that;
+- a fingerprinted path with a hash of its contents, e.g.
+  /static/stylesheets/style.3f9a0c1d2b4e.css, cached "forever": when the
+  file changes, so does the URL. Templates get these from `static_url`.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+from threading import Lock
+
+from werkzeug.http import is_resource_modified, parse_accept_header
+
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/javascript', 'application/json', 'image/svg+xml',
+    'image/x-icon', 'image/vnd.microsoft.icon')
+# gzip doesn't pay for itself below this size.
+MIN_COMPRESS_SIZE = 1024
+ONE_YEAR = 365 * 24 * 60 * 60
+
+
+class StaticFile:
+    """A static file's bytes and precomputed response headers."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.body = f.read()
+
+        self.mtime = os.stat(path).st_mtime
+        self.digest = hashlib.sha256(self.body).hexdigest()[:12]
+        self.etag = f'"{self.digest}"'
+
+        content_type, _ = mimetypes.guess_type(path)
+        self.content_type = content_type or 'application/octet-stream'
+        if self.content_type.startswith('text/'):
+            self.content_type += '; charset=utf-8'
+
+        self.gzipped = None
+        if (self.content_type.startswith(COMPRESSIBLE_TYPES)
+                and len(self.body) >= MIN_COMPRESS_SIZE):
+            gzipped = gzip.compress(self.body, compresslevel=9, mtime=0)
+            if len(gzipped) < len(self.body):
+                self.gzipped = gzipped
+
+    def fingerprinted(self, name):
+        """Return `name` with this file's content hash before the suffix."""
+
+        stem, suffix = os.path.splitext(name)
+        return f"{stem}.{self.digest}{suffix}"
+
+
+class StaticFiles:
+    """WSGI middleware serving the files under `root` at `prefix`.
+
+    Requests for anything else, including unknown files under `prefix`,
+    are passed on to `app`. With `autorefresh` (for development), files
+    are re-read when their modification time changes.
+    """
+
+    def __init__(self, app, root, prefix='/static/', max_age=3600,
+                 autorefresh=False):
+        self.app = app
+        self.root = root
+        self.prefix = prefix
+        self.max_age = max_age
+        self.autorefresh = autorefresh
+
+        self._files = {}
+        self._fingerprints = {}
+        self._lock = Lock()
+        self.scan()
+
+    def scan(self):
+        """(Re)load every file under `root`."""
+
+        with self._lock:
+            self._files.clear()
+            self._fingerprints.clear()
+
+            for directory, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    name = os.path.relpath(path, self.root).replace(
+                        os.sep, '/')
+                    self._add(name, StaticFile(path))
+
+    def url(self, name):
+        """Return the fingerprinted URL of file `name` (relative to root).
+
+        Unknown files get their plain URL.
+        """
+
+        static_file = self._lookup(name)
+        if static_file is None:
+            return self.prefix + name
+
+        return self.prefix + static_file.fingerprinted(name)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix):
+            return self.app(environ, start_response)
+
+        name = path[len(self.prefix):]
+        immutable = name in self._fingerprints
+        static_file = self._lookup(self._fingerprints.get(name, name))
+        if static_file is None:
+            return self.app(environ, start_response)
+
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [
+                ('Allow', 'GET, HEAD'), ('Content-Length', '0')])
+            return []
+
+        if immutable:
+            cache_control = f'public, max-age={ONE_YEAR}, immutable'
+        else:
+            cache_control = f'public, max-age={self.max_age}'
+
+        headers = [
+            ('Cache-Control', cache_control),
+            ('ETag', static_file.etag),
+        ]
+        if static_file.gzipped:
+            headers.append(('Vary', 'Accept-Encoding'))
+
+        if not is_resource_modified(environ, etag=static_file.etag):
+            start_response('304 Not Modified', headers)
+            return []
+
+        body = static_file.body
+        if static_file.gzipped and accepts_gzip(environ):
+            body = static_file.gzipped
+            headers.append(('Content-Encoding', 'gzip'))
+
+        headers += [
+            ('Content-Type', static_file.content_type),
+            ('Content-Length', str(len(body))),
+        ]
+        start_response('200 OK', headers)
+
+        return [] if environ['REQUEST_METHOD'] == 'HEAD' else [body]
+
+    def _add(self, name, static_file):
+        old = self._files.get(name)
+        if old is not None:
+            self._fingerprints.pop(old.fingerprinted(name), None)
+
+        self._files[name] = static_file
+        self._fingerprints[static_file.fingerprinted(name)] = name
+
+    def _lookup(self, name):
+        static_file = self._files.get(name)
+
+        if static_file is not None and self.autorefresh:
+            path = os.path.join(self.root, name)
+            try:
+                if os.stat(path).st_mtime != static_file.mtime:
+                    static_file = StaticFile(path)
+                    with self._lock:
+                        self._add(name, static_file)
+            except FileNotFoundError:
+                return None
+
+        return static_file
+
+
+def accepts_gzip(environ):
+    """Does the client accept a gzip-encoded response?"""
+
+    accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+    return accepted['gzip'] > 0
@@ -0,0 +1,219 @@
+"""Tests for lazy, cached `g.user`."""
+
+# run these tests like:
+#
+#    python -m unittest test_current_user.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+from query_stats import recorded_queries
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, CURR_USER_VERSION_KEY, user_snapshots
+from current_user import CurrentUser, UserSnapshotCache, load_user
+
+db.create_all()
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+class UserSnapshotCacheTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        self.user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_keyed_by_id_and_profile_version(self):
+        cache = UserSnapshotCache()
+        snapshot = cache.put(self.user)
+
+        self.assertEqual(
+            cache.get(self.user.id, self.user.profile_version), snapshot)
+        self.assertIsNone(
+            cache.get(self.user.id, self.user.profile_version + 1))
+
+    def test_expiry_and_invalidation(self):
+        cache = UserSnapshotCache(ttl=-1)
+        cache.put(self.user)
+        self.assertIsNone(cache.get(self.user.id, self.user.profile_version))
+
+        cache = UserSnapshotCache()
+        cache.put(self.user)
+        cache.invalidate(self.user.id)
+        self.assertIsNone(cache.get(self.user.id, self.user.profile_version))
+
+    def test_bounded(self):
+        cache = UserSnapshotCache(max_entries=1)
+        other = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        cache.put(self.user)
+        cache.put(other)
+
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get(self.user.id, self.user.profile_version))
+
+
+class CurrentUserTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+        self.snapshot = UserSnapshotCache().put(user)
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_snapshot_attributes_need_no_query(self):
+        current = CurrentUser(self.snapshot)
+
+        with recorded_queries() as queries:
+            self.assertEqual(current.id, self.user_id)
+            self.assertEqual(current.username, "u1")
+
+        self.assertEqual(queries, [])
+
+    def test_other_attributes_load_the_user_once(self):
+        current = CurrentUser(self.snapshot)
+
+        with recorded_queries() as queries:
+            self.assertEqual(current.email, "u1@email.com")
+            self.assertEqual(current.following_count, 0)
+
+        self.assertEqual(len(queries), 1)
+        self.assertIsInstance(current.model, User)
+
+    def test_assignments_go_to_the_user(self):
+        current = CurrentUser(self.snapshot)
+        current.username = "renamed"
+
+        self.assertEqual(current.model.username, "renamed")
+        self.assertEqual(current.username, "renamed")
+
+    def test_load_user_defers_password_and_bio(self):
+        user = load_user(self.user_id)
+
+        self.assertNotIn('password', vars(user))
+        self.assertNotIn('bio', vars(user))
+
+
+class GlobalUserViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        user_snapshots.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, url):
+        db.session.remove()
+        with recorded_queries() as queries:
+            response = self.client.get(url)
+        return response, queries
+
+    def test_anonymous_requests_dont_query(self):
+        response, queries = self.get("/login")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+    def test_cached_user_isnt_queried(self):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+
+        # Only the nav bar needs the user here.
+        response, queries = self.get("/messages/new")
+        self.assertEqual(len(queries), 1)
+
+        response, queries = self.get("/messages/new")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("u1", response.get_data(as_text=True))
+        self.assertEqual(queries, [])
+
+    def test_stale_profile_version_is_resynced(self):
+        """A session that missed an edit made elsewhere catches up."""
+
+        User.query.filter_by(id=self.user_id).update(
+            {User.profile_version: User.profile_version + 1})
+        db.session.commit()
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+            session[CURR_USER_VERSION_KEY] = 0
+
+        response, queries = self.get("/messages/new")
+        self.assertEqual(len(queries), 1)
+
+        response, queries = self.get("/messages/new")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+    def test_profile_edit_refreshes_snapshot(self):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+        self.get("/messages/new")
+
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            self.client.post("/users/profile", data={
+                "username": "renamed",
+                "password": "password",
+            })
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+        response, _ = self.get("/messages/new")
+        self.assertIn('alt="renamed"', response.get_data(as_text=True))
+
+    def test_deleted_user_is_logged_out(self):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+        self.get("/messages/new")
+
+        User.query.filter_by(id=self.user_id).delete()
+        db.session.commit()
+        user_snapshots.clear()
+
+        response, _ = self.get("/messages/new")
+        self.assertEqual(response.status_code, 302)
+
+    def test_user_deleted_elsewhere_is_logged_out(self):
+        """A cached snapshot of a user deleted by another process doesn't
+        outlive the first access to the user's row."""
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+        self.get("/messages/new")
+
+        # Deleted by another process, so this one's snapshot stays.
+        User.query.filter_by(id=self.user_id).delete()
+        db.session.commit()
+
+        response, _ = self.get("/users/profile")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.location, "/")
+        with self.client.session_transaction() as session:
+            self.assertNotIn(CURR_USER_KEY, session)
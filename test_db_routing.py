@@ -0,0 +1,157 @@
+"""Read replica routing tests.
+
+These use a second local database, warbler_test_replica, standing in for
+a replica. Nothing replicates into it: each test copies in the rows it
+needs, and rows that differ between the two databases show which one a
+read went to.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_db_routing.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, PRIMARY_UNTIL_KEY
+
+REPLICA_URL = "postgresql:///warbler_test_replica"
+
+db.create_all()
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+def create_replica_database():
+    """Create the replica database and its tables, if not there yet."""
+
+    server = create_engine(
+        "postgresql:///postgres", isolation_level="AUTOCOMMIT")
+    with server.connect() as connection:
+        found = connection.execute(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {"name": "warbler_test_replica"}).scalar()
+        if not found:
+            connection.execute(text("CREATE DATABASE warbler_test_replica"))
+    server.dispose()
+
+    replica = create_engine(REPLICA_URL)
+    db.metadata.create_all(replica)
+    return replica
+
+
+class ReadReplicaTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.replica = create_replica_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.replica.dispose()
+
+    def setUp(self):
+        self.binds = app.config['SQLALCHEMY_BINDS']
+        self.replica_binds = app.config['SQLALCHEMY_REPLICA_BINDS']
+        app.config['SQLALCHEMY_BINDS'] = {'replica0': REPLICA_URL}
+        app.config['SQLALCHEMY_REPLICA_BINDS'] = ['replica0']
+
+        User.query.delete()
+        self.user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        # The replica has u1, with a bio only it has.
+        with self.replica.begin() as connection:
+            connection.execute(text("TRUNCATE users CASCADE"))
+            connection.execute(User.__table__.insert(), [dict(
+                id=self.user_id, username="u1", email="u1@email.com",
+                password=self.user.password, bio="Read from the replica")])
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+        db.get_engine(app, bind='replica0').dispose()
+        app.config['SQLALCHEMY_BINDS'] = self.binds
+        app.config['SQLALCHEMY_REPLICA_BINDS'] = self.replica_binds
+
+    def get_text(self, url):
+        return self.client.get(url).get_data(as_text=True)
+
+    def test_session_reads_from_replica_until_it_writes(self):
+        db.session.remove()
+        db.session.info['use_replica'] = True
+
+        self.assertEqual(
+            User.query.get(self.user_id).bio, "Read from the replica")
+
+        db.session.add(Message(text="Hello", user_id=self.user_id))
+        db.session.flush()
+
+        self.assertTrue(db.session.info['wrote'])
+        self.assertEqual(Message.query.count(), 1)
+        db.session.rollback()
+        db.session.remove()
+
+    def test_writes_go_to_primary(self):
+        db.session.remove()
+        db.session.info['use_replica'] = True
+
+        User.query.filter_by(id=self.user_id).update({'bio': "Updated"})
+        db.session.commit()
+        db.session.remove()
+
+        self.assertEqual(User.query.get(self.user_id).bio, "Updated")
+        with self.replica.connect() as connection:
+            bio = connection.execute(
+                text("SELECT bio FROM users WHERE id = :id"),
+                {"id": self.user_id}).scalar()
+        self.assertEqual(bio, "Read from the replica")
+
+    def test_get_requests_read_from_replica(self):
+        html = self.get_text(f"/users/{self.user_id}")
+        self.assertIn("Read from the replica", html)
+
+    def test_reads_own_writes_after_post(self):
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        try:
+            resp = self.client.post(
+                "/messages/new", data={"text": "Fresh off the primary"})
+            self.assertEqual(resp.status_code, 302)
+
+            # The replica doesn't have the message yet; the primary does.
+            html = self.get_text(f"/users/{self.user_id}")
+            self.assertIn("Fresh off the primary", html)
+
+            # Once the window has passed, reads go back to the replica.
+            with self.client.session_transaction() as session:
+                session[PRIMARY_UNTIL_KEY] = 0
+            html = self.get_text(f"/users/{self.user_id}")
+            self.assertNotIn("Fresh off the primary", html)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+    def test_no_replicas_configured(self):
+        app.config['SQLALCHEMY_REPLICA_BINDS'] = []
+
+        html = self.get_text(f"/users/{self.user_id}")
+        self.assertNotIn("Read from the replica", html)
@@ -0,0 +1,70 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragment_cache.py
+
+
+from unittest import TestCase
+
+from fragment_cache import FragmentCache
+
+
+class FragmentCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = FragmentCache(max_entries=3)
+        self.renders = 0
+
+    def render(self, html="<li>"):
+        def render():
+            self.renders += 1
+            return html
+        return render
+
+    def test_hit_reuses_fragment(self):
+        self.cache.get_or_render((1, 0, "liked"), 10, self.render())
+        html = self.cache.get_or_render((1, 0, "liked"), 10, self.render())
+
+        self.assertEqual(html, "<li>")
+        self.assertEqual(self.renders, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_like_state_and_version_are_separate_entries(self):
+        self.cache.get_or_render((1, 0, "liked"), 10, self.render())
+        self.cache.get_or_render((1, 0, "unliked"), 10, self.render())
+        self.cache.get_or_render((1, 1, "liked"), 10, self.render())
+
+        self.assertEqual(self.renders, 3)
+
+    def test_lru_eviction(self):
+        for message_id in (1, 2, 3):
+            self.cache.get_or_render((message_id, 0, "own"), 10, self.render())
+        self.cache.get_or_render((1, 0, "own"), 10, self.render())
+        self.cache.get_or_render((4, 0, "own"), 10, self.render())
+
+        self.assertEqual(len(self.cache), 3)
+        self.cache.get_or_render((1, 0, "own"), 10, self.render())
+        self.assertEqual(self.renders, 4)
+        self.cache.get_or_render((2, 0, "own"), 10, self.render())
+        self.assertEqual(self.renders, 5)
+
+    def test_invalidate_message(self):
+        self.cache.get_or_render((1, 0, "liked"), 10, self.render())
+        self.cache.get_or_render((1, 0, "unliked"), 10, self.render())
+        self.cache.get_or_render((2, 0, "liked"), 10, self.render())
+
+        self.cache.invalidate_message(1)
+
+        self.assertEqual(len(self.cache), 1)
+        self.cache.invalidate_author(10)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_author(self):
+        self.cache.get_or_render((1, 0, "own"), 10, self.render())
+        self.cache.get_or_render((2, 0, "own"), 20, self.render())
+
+        self.cache.invalidate_author(10)
+
+        self.assertEqual(len(self.cache), 1)
+        self.cache.get_or_render((2, 0, "own"), 20, self.render())
+        self.assertEqual(self.renders, 2)
@@ -9,7 +9,7 @@
 import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError, DataError
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -83,15 +83,97 @@ class MessageModelTestCase(TestCase):
         self.assertNotEqual(m1.user,u2)
 
 
+class TimelineEntryTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
 
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
 
+        self.u1_id = u1.id
+        self.u2_id = u2.id
 
+    def tearDown(self):
+        db.session.rollback()
 
+    def post(self, user_id, text):
+        msg = Message(text=text, user_id=user_id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        db.session.commit()
+        return msg
+
+    def test_fan_out_reaches_author_and_followers(self):
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u2.following.append(u1)
+        db.session.commit()
+
+        msg = self.post(self.u1_id, "hello")
 
+        self.assertEqual(TimelineEntry.messages_for(self.u1_id), [msg])
+        self.assertEqual(TimelineEntry.messages_for(self.u2_id), [msg])
 
+    def test_fan_out_skips_non_followers(self):
+        self.post(self.u1_id, "hello")
 
+        self.assertEqual(TimelineEntry.messages_for(self.u2_id), [])
 
+    def test_backfill_and_prune(self):
+        msg = self.post(self.u1_id, "hello")
 
+        TimelineEntry.backfill(self.u2_id, self.u1_id)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.messages_for(self.u2_id), [msg])
 
+        TimelineEntry.prune(self.u2_id, self.u1_id)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.messages_for(self.u2_id), [])
 
+    def test_messages_for_newest_first(self):
+        m1 = self.post(self.u1_id, "first")
+        m2 = self.post(self.u1_id, "second")
+
+        self.assertEqual(TimelineEntry.messages_for(self.u1_id), [m2, m1])
+        self.assertEqual(TimelineEntry.messages_for(self.u1_id, limit=1), [m2])
+
+    def test_rebuild(self):
+        u2 = User.query.get(self.u2_id)
+        u2.following.append(User.query.get(self.u1_id))
+        msg = Message(text="bulk", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.messages_for(self.u1_id), [msg])
+        self.assertEqual(TimelineEntry.messages_for(self.u2_id), [msg])
+
+    def test_rebuild_one_owner(self):
+        u2 = User.query.get(self.u2_id)
+        u2.following.append(User.query.get(self.u1_id))
+        msg = Message(text="bulk", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        TimelineEntry.rebuild(owner_id=self.u2_id)
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.messages_for(self.u1_id), [])
+        self.assertEqual(TimelineEntry.messages_for(self.u2_id), [msg])
+
+    def test_timeline_for(self):
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        u2 = User.query.get(self.u2_id)
+        u2.following.append(User.query.get(self.u1_id))
+        m1 = Message(text="by u1", user_id=self.u1_id)
+        m2 = Message(text="by u2", user_id=self.u2_id)
+        m3 = Message(text="by u3", user=u3)
+        db.session.add_all([m1, m2, m3])
+        db.session.commit()
 
+        self.assertEqual(
+            set(Message.timeline_for(self.u2_id).all()), {m1, m2})
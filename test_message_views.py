@@ -8,7 +8,11 @@
 import os
 from unittest import TestCase
 
-from models import db, Message, User
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+from models import db, Message, User, TimelineEntry
+from query_stats import recorded_queries, query_budget
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, user_snapshots
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -66,3 +70,235 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 302)
 
             Message.query.filter_by(text="Hello").one()
+
+    def test_add_message_reaches_follower_home(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u2.following.append(User.query.get(self.u1_id))
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+            resp = c.get("/")
+
+            self.assertIn("Fanned out", resp.get_data(as_text=True))
+
+
+class MessageFollowTimelineTestCase(MessageBaseViewTestCase):
+    def test_follow_backfills_and_unfollow_prunes(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            c.post(f"/users/follow/{self.u1_id}")
+            resp = c.get("/")
+            self.assertIn("m1-text", resp.get_data(as_text=True))
+
+            c.post(f"/users/stop-following/{self.u1_id}")
+            resp = c.get("/")
+            self.assertNotIn("m1-text", resp.get_data(as_text=True))
+
+
+class MessageTimelinePagingTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        TimelineEntry.rebuild()
+        for i in range(3):
+            msg = Message(text=f"paged-{i}", user_id=self.u1_id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        app.config['TIMELINE_PAGE_SIZE'] = 2
+
+    def tearDown(self):
+        app.config['TIMELINE_PAGE_SIZE'] = 100
+
+    def test_cursor_pages_through_timeline(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/?partial=1")
+            html = resp.get_data(as_text=True)
+            self.assertIn("paged-2", html)
+            self.assertIn("paged-1", html)
+            self.assertNotIn("<html", html)
+
+            cursor = resp.headers["X-Next-Cursor"]
+            resp = c.get("/", query_string={"before": cursor, "partial": 1})
+            html = resp.get_data(as_text=True)
+            self.assertIn("paged-0", html)
+            self.assertIn("m1-text", html)
+            self.assertNotIn("paged-2", html)
+
+            cursor = resp.headers["X-Next-Cursor"]
+            resp = c.get("/", query_string={"before": cursor, "partial": 1})
+            self.assertNotIn("X-Next-Cursor", resp.headers)
+            self.assertNotIn("<li", resp.get_data(as_text=True))
+
+    def test_malformed_cursor(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/?before=yesterday")
+            self.assertEqual(resp.status_code, 400)
+
+
+class MessageLikedStateTestCase(MessageBaseViewTestCase):
+    def test_show_message_liked_state(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertIn(f"/messages/{self.m1_id}/like",
+                          resp.get_data(as_text=True))
+
+            c.post(f"/messages/{self.m1_id}/like")
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertIn(f"/messages/{self.m1_id}/unlike",
+                          resp.get_data(as_text=True))
+
+
+class MessageCountersTestCase(MessageBaseViewTestCase):
+    def test_post_like_and_delete_update_counts(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/messages/new", data={"text": "Counted"})
+            msg_id = Message.query.filter_by(text="Counted").one().id
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+            c.post(f"/messages/{msg_id}/like")
+            self.assertEqual(User.query.get(u2_id).likes_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 0)
+            self.assertEqual(User.query.get(u2_id).likes_count, 0)
+
+
+class MessageFragmentCacheTestCase(MessageBaseViewTestCase):
+    def test_profile_edit_refreshes_cached_items(self):
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertIn("@u1<", c.get("/").get_data(as_text=True))
+
+            c.post("/users/profile", data={
+                "username": "renamed",
+                "password": "password",
+            })
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("@renamed<", html)
+            self.assertNotIn("@u1<", html)
+
+
+class MessageListQueryCountTestCase(MessageBaseViewTestCase):
+    """Message-list pages must not issue a query per message author."""
+
+    def add_authors(self, count):
+        # Authors are deliberately not followed, so the viewer's following
+        # collection can't pre-populate the identity map with them.
+        viewer = User.query.get(self.u1_id)
+        for i in range(count):
+            n = User.query.count()
+            author = User.signup(
+                f"author{n}", f"author{n}@email.com", "password", None)
+            msg = Message(text="by author", user=author)
+            viewer.liked_messages.append(msg)
+            db.session.flush()
+            TimelineEntry.backfill(viewer.id, author.id)
+        db.session.commit()
+
+    def queries_for(self, url):
+        # Start from an empty identity map, as a real request would, and
+        # the same (cold) g.user cache every time.
+        db.session.remove()
+        user_snapshots.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with recorded_queries() as statements:
+                resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            return len(statements)
+
+    def assert_constant_queries(self, url):
+        self.add_authors(2)
+        few = self.queries_for(url)
+        self.add_authors(5)
+        many = self.queries_for(url)
+
+        self.assertEqual(few, many)
+
+    def test_homepage_query_count(self):
+        self.assert_constant_queries("/")
+
+    def test_liked_messages_query_count(self):
+        self.assert_constant_queries(f"/users/{self.u1_id}/likes")
+
+    def test_homepage_query_budget(self):
+        self.add_authors(5)
+        db.session.remove()
+        for key in ('QUERY_STATS_HEADERS', 'EXPOSE_METRICS'):
+            self.addCleanup(app.config.__setitem__, key, app.config.get(key))
+        app.config['QUERY_STATS_HEADERS'] = True
+        app.config['EXPOSE_METRICS'] = True
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            # g.user, the inbox page, popular accounts pulled in, the
+            # viewer's likes among the page and who to follow.
+            with query_budget(5):
+                resp = c.get("/")
+
+            self.assertEqual(resp.headers["X-DB-Query-Count"], "5")
+
+            endpoints = c.get("/_metrics").get_json()["queries"]
+            self.assertIn("homepage", [e["endpoint"] for e in endpoints])
+
+    def test_failed_query_leaves_no_start_time(self):
+        with db.engine.connect() as connection:
+            with self.assertRaises(ProgrammingError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+
+            self.assertEqual(connection.info['query_start_times'], [])
+
+    def test_query_budget_fails_when_exceeded(self):
+        with self.assertRaises(AssertionError):
+            with query_budget(1):
+                User.query.all()
+                Message.query.all()
@@ -0,0 +1,182 @@
+"""Password hashing pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_password_hashing.py
+
+
+import os
+from contextlib import contextmanager
+from threading import Event, Thread
+from unittest import TestCase
+
+from models import db, User, password_hasher
+from password_hashing import (
+    HashingUnavailable, PasswordHasher, calibrate, hash_rounds)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, login_throttle, CURR_USER_KEY
+
+db.create_all()
+
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+class PasswordHasherTestCase(TestCase):
+    def test_inline_round_trip(self):
+        hasher = PasswordHasher(rounds=4, workers=0)
+
+        hashed = hasher.hash("password")
+
+        self.assertEqual(hash_rounds(hashed), 4)
+        self.assertTrue(hasher.check(hashed, "password"))
+        self.assertFalse(hasher.check(hashed, "wrong"))
+        self.assertEqual(hasher.stats()["completed"], 3)
+
+    def test_pool_round_trip(self):
+        hasher = PasswordHasher(rounds=4, workers=1)
+        self.addCleanup(hasher.shutdown)
+
+        hashed = hasher.hash("password")
+
+        self.assertTrue(hasher.check(hashed, "password"))
+        self.assertFalse(hasher.check(hashed, "wrong"))
+
+        stats = hasher.stats()
+        self.assertEqual(stats["completed"], 3)
+        self.assertEqual(stats["pending"], 0)
+
+    def test_rejects_when_full(self):
+        """Once max_pending hashes are in flight, more are refused."""
+
+        hasher = PasswordHasher(rounds=4, workers=0, max_pending=1)
+        hashed = hasher.hash("password")
+        started = Event()
+        release = Event()
+
+        def slow_check(password_hash, password):
+            started.set()
+            release.wait(5)
+            return True
+
+        thread = Thread(target=hasher._run, args=(slow_check, hashed, "x"))
+        thread.start()
+        started.wait(5)
+
+        try:
+            with self.assertRaises(HashingUnavailable):
+                hasher.check(hashed, "password")
+            self.assertEqual(hasher.stats()["pending"], 1)
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(hasher.stats()["rejected"], 1)
+        self.assertTrue(hasher.check(hashed, "password"))
+
+    def test_timeout(self):
+        hasher = PasswordHasher(rounds=16, workers=1, timeout=0.01)
+        self.addCleanup(hasher.shutdown)
+
+        with self.assertRaises(HashingUnavailable):
+            hasher.hash("password")
+
+        self.assertEqual(hasher.stats()["timed_out"], 1)
+
+    def test_needs_rehash(self):
+        hasher = PasswordHasher(rounds=5, workers=0)
+
+        self.assertFalse(hasher.needs_rehash(hasher.hash("password")))
+        self.assertTrue(hasher.needs_rehash(
+            PasswordHasher(rounds=4, workers=0).hash("password")))
+
+    def test_calibrate(self):
+        rounds, timings = calibrate(
+            target_ms=1000, min_rounds=4, max_rounds=6, samples=1)
+
+        self.assertEqual(list(timings), [4, 5, 6])
+        self.assertEqual(rounds, 6)
+
+        # An unreachable target still gets the minimum cost.
+        rounds, timings = calibrate(target_ms=0, min_rounds=4, samples=1)
+        self.assertEqual((rounds, list(timings)), (4, [4]))
+
+    def test_init_app(self):
+        hasher = PasswordHasher()
+        hasher.init_app(app)
+
+        self.assertEqual(hasher.rounds, app.config['PASSWORD_HASH_ROUNDS'])
+        self.assertEqual(hasher.workers, app.config['PASSWORD_HASH_WORKERS'])
+
+
+class BusyHashingViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+        login_throttle.store.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    @contextmanager
+    def pool_full(self):
+        """Take every hashing slot for the duration."""
+
+        max_pending = password_hasher.max_pending
+        for _ in range(max_pending):
+            password_hasher._slots.acquire()
+
+        try:
+            yield
+        finally:
+            for _ in range(max_pending):
+                password_hasher._slots.release()
+
+    def test_login_when_busy(self):
+        """A full hashing pool turns logins away with a 503."""
+
+        with self.pool_full():
+            resp = self.client.post(
+                '/login', data={'username': 'u1', 'password': 'password'})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '5')
+        self.assertIn("try again", resp.get_data(as_text=True))
+
+        resp = self.client.post(
+            '/login', data={'username': 'u1', 'password': 'password'})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_profile_edit_when_busy(self):
+        """So do profile edits, which check the password too."""
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+        data = {'username': 'u1', 'email': 'u1@email.com',
+                'bio': 'Edited', 'password': 'password'}
+
+        with self.pool_full():
+            resp = self.client.post('/users/profile', data=data)
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '5')
+        self.assertIn("try again", resp.get_data(as_text=True))
+        self.assertIsNone(User.query.get(self.user_id).bio)
+
+        resp = self.client.post('/users/profile', data=data)
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(User.query.get(self.user_id).bio, 'Edited')
@@ -0,0 +1,208 @@
+"""Query plan tests for the hot pages, and the migrations that index them."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from models import db, User, Message, TimelineEntry
+from query_stats import explain, plan_nodes, recorded_executions
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from migrations import MIGRATIONS, upgrade
+
+db.create_all()
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+USERS = 2000
+MESSAGES_PER_USER = 20
+FOLLOWS_PER_USER = 10
+
+# Tables that grow with use; no hot page may scan one of them whole.
+LARGE_TABLES = {'users', 'messages', 'follows', 'likes', 'timeline_entries'}
+
+
+def seed():
+    """Fill the database with enough rows that Postgres plans as it would
+    in production (on a handful of rows a sequential scan always wins)."""
+
+    db.session.execute(text("TRUNCATE users CASCADE"))
+    db.session.execute(User.__table__.insert(), [
+        dict(username=f"user{i:04}", email=f"user{i}@example.com",
+             password="not-a-hash", bio=f"Bio of user {i}")
+        for i in range(USERS)
+    ])
+
+    first_id = db.session.execute(text("SELECT min(id) FROM users")).scalar()
+    params = {"first": first_id, "users": USERS}
+
+    db.session.execute(text(
+        "INSERT INTO messages (text, timestamp, user_id) "
+        "SELECT 'Message ' || n, now() - n * interval '1 minute', "
+        "       :first + n % :users "
+        "FROM generate_series(1, :count) n"),
+        dict(params, count=USERS * MESSAGES_PER_USER))
+    db.session.execute(text(
+        "INSERT INTO follows (user_following_id, user_being_followed_id) "
+        "SELECT id, :first + (id - :first + k) % :users "
+        "FROM users, generate_series(1, :per_user) k"),
+        dict(params, per_user=FOLLOWS_PER_USER))
+    db.session.execute(text(
+        "INSERT INTO likes (message_being_liked_id, user_liking_message_id) "
+        "SELECT id, :first + id / 2 * 7 % :users "
+        "FROM messages WHERE id % 2 = 0"),
+        params)
+
+    User.recount()
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+    with db.engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+            text("ANALYZE"))
+
+    return first_id
+
+
+class QueryPlanTestCase(TestCase):
+    """Each hot page's queries use the indexes meant for them."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.user_id = seed() + USERS // 2
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        db.session.execute(text("TRUNCATE users CASCADE"))
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def plans_for(self, url):
+        """GET `url` and return the plans of the queries it ran."""
+
+        with recorded_executions() as executions:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        connection = db.session.connection()
+        return [explain(connection, statement, parameters)
+                for statement, parameters in executions]
+
+    def assertIndexed(self, url, index):
+        """Assert that `url` uses `index` and scans no large table whole."""
+
+        nodes = [node
+                 for plan in self.plans_for(url)
+                 for node in plan_nodes(plan)]
+
+        seq_scans = {node['Relation Name']
+                     for node in nodes
+                     if node['Node Type'] == 'Seq Scan'}
+        self.assertEqual(seq_scans & LARGE_TABLES, set(), url)
+
+        indexes = {node.get('Index Name') for node in nodes}
+        self.assertIn(index, indexes, url)
+
+    def test_homepage(self):
+        self.assertIndexed("/", 'ix_timeline_entries_owner_timestamp')
+
+    def test_show_user(self):
+        self.assertIndexed(
+            f"/users/{self.user_id}", 'ix_messages_user_timestamp')
+
+    def test_show_liked_messages(self):
+        self.assertIndexed(
+            f"/users/{self.user_id}/likes", 'ix_likes_user_message')
+
+    def test_show_following(self):
+        self.assertIndexed(
+            f"/users/{self.user_id}/following",
+            'ix_follows_following_followed')
+
+    def test_list_users(self):
+        self.assertIndexed("/users?after=user1000", 'users_username_key')
+
+
+class MigrationTestCase(TestCase):
+    def setUp(self):
+        # Concurrent index builds wait for every open transaction.
+        db.session.remove()
+
+    def indexes(self):
+        return set(db.session.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = 'public'"))
+            .scalars())
+
+    def test_upgrade_adds_missing_indexes_once(self):
+        db.session.execute(text(
+            "DROP INDEX IF EXISTS ix_likes_user_message, "
+            "ix_timeline_entries_message"))
+        db.session.execute(text("DROP TABLE IF EXISTS schema_migrations"))
+        db.session.commit()
+        db.session.remove()
+
+        applied = upgrade()
+
+        self.assertEqual(applied, MIGRATIONS)
+        self.assertLessEqual(
+            {'ix_likes_user_message', 'ix_timeline_entries_message'},
+            self.indexes())
+        db.session.remove()
+
+        self.assertEqual(upgrade(), [])
+
+    def test_upgrade_adds_user_columns_with_counts(self):
+        """A users table from before the counters gets them, filled in."""
+
+        db.session.execute(text("TRUNCATE users CASCADE"))
+        author = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        db.session.add(Message(text="Hello", user_id=author.id))
+        db.session.commit()
+        author_id = author.id
+
+        db.session.execute(text(
+            "ALTER TABLE users "
+            "DROP COLUMN profile_version, DROP COLUMN version, "
+            "DROP COLUMN messages_count, DROP COLUMN followers_count, "
+            "DROP COLUMN following_count, DROP COLUMN likes_count"))
+        db.session.execute(text("DROP TABLE IF EXISTS schema_migrations"))
+        db.session.commit()
+        db.session.remove()
+
+        upgrade()
+
+        author = User.query.get(author_id)
+        self.assertEqual(
+            (author.profile_version, author.version, author.messages_count,
+             author.followers_count, author.following_count,
+             author.likes_count),
+            (0, 0, 1, 0, 0, 0))
+
+        db.session.execute(text("TRUNCATE users CASCADE"))
+        db.session.commit()
+        db.session.remove()
@@ -0,0 +1,140 @@
+"""Recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Recommendation
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from recommendations import recommend, refresh_recommendations
+
+
+def recommendations(edges, **kwargs):
+    """Return recommend()'s output as a list of (user, recommended, score)."""
+
+    edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+    return [
+        row
+        for block in recommend(np.unique(edges), edges, **kwargs)
+        for row in zip(*(column.tolist() for column in block))
+    ]
+
+
+db.create_all()
+
+
+class RecommendTestCase(TestCase):
+    def test_friends_of_friends_and_shared_followers(self):
+        # 1 follows 2 and 3; 2 and 3 both follow 4; 5 follows 1 and 6.
+        rows = {
+            (user_id, recommended_id): score
+            for user_id, recommended_id, score in recommendations(
+                [(1, 2), (1, 3), (2, 4), (3, 4), (5, 1), (5, 6)])
+        }
+
+        # Two of 1's follows follow 4.
+        self.assertEqual(rows[(1, 4)], 2.0)
+        # 1 and 6 share a follower (5).
+        self.assertEqual(rows[(1, 6)], 0.5)
+        # Never yourself, never someone you already follow.
+        self.assertNotIn((1, 1), rows)
+        self.assertNotIn((1, 2), rows)
+        self.assertNotIn((5, 1), rows)
+
+    def test_best_first_limited_per_user(self):
+        edges = [(1, 2), (1, 3), (2, 4), (3, 4), (2, 5), (2, 6)]
+
+        for block_size in (1, 2, 100):
+            recommended = [
+                recommended_id
+                for user_id, recommended_id, _ in recommendations(
+                    edges, per_user=2, block_size=block_size)
+                if user_id == 1
+            ]
+
+            self.assertEqual(recommended, [4, 5])
+
+    def test_blocks_match_whole_graph(self):
+        edges = [(1, 2), (1, 3), (2, 4), (3, 4), (5, 1), (5, 6), (6, 2)]
+
+        self.assertEqual(
+            recommendations(edges, block_size=2),
+            recommendations(edges, block_size=100))
+
+    def test_empty_graph(self):
+        self.assertEqual(recommendations([]), [])
+
+
+class RefreshRecommendationsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        self.users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(4)
+        ]
+        db.session.commit()
+        u0, u1, u2, u3 = self.users
+
+        u0.following.append(u1)
+        u1.following.append(u2)
+        u1.following.append(u3)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_refresh_replaces_recommendations(self):
+        u0, u1, u2, u3 = self.users
+
+        self.assertEqual(refresh_recommendations(), 4)
+        db.session.commit()
+        self.assertEqual(
+            [u.username for u in Recommendation.users_for(u0.id)],
+            ["u2", "u3"])
+
+        u0.following.append(u2)
+        db.session.commit()
+
+        # Already-followed users drop out before the next refresh, too.
+        self.assertEqual(
+            [u.username for u in Recommendation.users_for(u0.id)], ["u3"])
+
+        refresh_recommendations()
+        db.session.commit()
+        self.assertEqual(
+            Recommendation.query.filter_by(
+                user_id=u0.id, recommended_id=u2.id).count(),
+            0)
+
+    def test_homepage_shows_who_to_follow(self):
+        refresh_recommendations()
+        db.session.commit()
+        u0_id, u2_id = self.users[0].id, self.users[2].id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0_id
+
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("Who to follow", html)
+        self.assertIn(f'action="/users/follow/{u2_id}"', html)
@@ -0,0 +1,248 @@
+"""User search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, user_search, warm_up
+from search import (
+    NgramIndex, UserSearch, UsernamePrefixIndex, build_prefix_index,
+    escape_like)
+
+db.create_all()
+
+
+class NgramIndexTestCase(TestCase):
+    def setUp(self):
+        self.index = NgramIndex()
+        self.index.add(1, "BirdWatcher", "I love warblers")
+        self.index.add(2, "bird", None)
+        self.index.add(3, "songbird", "Loud in the mornings")
+        self.index.add(4, "owl", "Watching birds at night")
+
+    def test_case_insensitive_ranked(self):
+        self.assertEqual(self.index.search("BIRD"), [2, 1, 3, 4])
+
+    def test_bio_matches(self):
+        self.assertEqual(self.index.search("warbler"), [1])
+        self.assertEqual(self.index.search("morning"), [3])
+
+    def test_short_terms_match_usernames(self):
+        self.assertEqual(self.index.search("ow"), [4])
+        self.assertEqual(self.index.search("s"), [3])
+
+    def test_no_match(self):
+        self.assertEqual(self.index.search("penguin"), [])
+        self.assertEqual(self.index.search("  "), [])
+
+    def test_limit(self):
+        self.assertEqual(self.index.search("bird", limit=2), [2, 1])
+
+    def test_reindex_and_remove(self):
+        self.index.add(2, "parrot", None)
+        self.assertEqual(self.index.search("bird"), [1, 3, 4])
+        self.assertEqual(self.index.search("parrot"), [2])
+
+        self.index.remove(1)
+        self.assertEqual(self.index.search("bird"), [3, 4])
+
+    def test_escape_like(self):
+        self.assertEqual(escape_like("100%_a\\b"), "100\\%\\_a\\\\b")
+
+
+class UserSearchViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("Warbler", "u1@email.com", "password", None)
+        User.signup("the_warbler_fan", "u2@email.com", "password", None)
+        u3 = User.signup("crow", "u3@email.com", "password", None)
+        u3.bio = "Not a WARBLER at all"
+        db.session.commit()
+        self.u1_id = u1.id
+
+        user_search.index = None
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_search_is_ranked_and_case_insensitive(self):
+        users = user_search.search("warbler")
+
+        self.assertEqual(
+            [u.username for u in users],
+            ["Warbler", "the_warbler_fan", "crow"])
+
+    def test_search_sees_new_signups(self):
+        user_search.search("warbler")
+
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            self.client.post("/signup", data={
+                "username": "warbler2",
+                "email": "w2@email.com",
+                "password": "password",
+            })
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+        self.assertIn(
+            "warbler2", [u.username for u in user_search.search("warbler")])
+
+    def test_stale_index_rebuilds_in_background(self):
+        """Searches keep using the old index while a new one is built."""
+
+        search = UserSearch(refresh_seconds=0)
+        search.search("warbler")
+        old_index = search.index
+
+        User.signup("warbler3", "w3@email.com", "password", None)
+        db.session.commit()
+
+        self.assertNotIn(
+            "warbler3", [u.username for u in search.search("warbler")])
+        for thread in threading.enumerate():
+            if thread.name == "user-search-index":
+                thread.join()
+
+        self.assertIsNot(search.index, old_index)
+        search.refresh_seconds = 300
+        self.assertIn(
+            "warbler3", [u.username for u in search.search("warbler")])
+
+    def test_changes_during_rebuild_are_replayed(self):
+        """Edits made while an index is built aren't lost when it's
+        swapped in."""
+
+        search = UserSearch()
+        warbler = User.query.get(self.u1_id)
+        crow = User.query.filter_by(username="crow").one()
+
+        def build():
+            index = build_prefix_index()
+            # Made after the build read the users.
+            warbler.username = "raven"
+            search.user_changed(warbler)
+            search.user_removed(crow.id)
+            return index
+
+        with patch('search.build_prefix_index', build):
+            search.load_usernames()
+
+        self.assertEqual(search.autocomplete("ra"), [(self.u1_id, "raven")])
+        self.assertEqual(search.autocomplete("cr"), [])
+        self.assertEqual(search.autocomplete("warb"), [])
+
+    def test_list_users_search(self):
+        with self.client as client:
+            with client.session_transaction() as session:
+                session["curr_user"] = self.u1_id
+
+            html = client.get("/users?q=FAN").get_data(as_text=True)
+
+            self.assertIn("@the_warbler_fan", html)
+            self.assertNotIn("@crow", html)
+
+
+class UsernamePrefixIndexTestCase(TestCase):
+    def setUp(self):
+        self.index = UsernamePrefixIndex(
+            [(1, "Bird"), (2, "birdwatcher"), (3, "bison"), (4, "owl")])
+
+    def test_complete_is_case_insensitive_and_sorted(self):
+        self.assertEqual(
+            self.index.complete("BIR"), [(1, "Bird"), (2, "birdwatcher")])
+        self.assertEqual(self.index.complete("bi", limit=1), [(1, "Bird")])
+
+    def test_no_completions(self):
+        self.assertEqual(self.index.complete("z"), [])
+        self.assertEqual(self.index.complete(""), [])
+        self.assertEqual(self.index.complete("owls"), [])
+
+    def test_add_rename_and_remove(self):
+        self.index.add(5, "bittern")
+        self.index.add(1, "raven")
+        self.index.remove(3)
+
+        self.assertEqual(
+            self.index.complete("bi"), [(2, "birdwatcher"), (5, "bittern")])
+        self.assertEqual(self.index.complete("r"), [(1, "raven")])
+        self.assertEqual(len(self.index), 4)
+
+
+class AutocompleteViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("Warbler", "u1@email.com", "password", None)
+        User.signup("warbling", "u2@email.com", "password", None)
+        User.signup("crow", "u3@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        user_search.load_usernames()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_autocomplete(self):
+        with self.client.session_transaction() as session:
+            session["curr_user"] = self.u1_id
+
+        response = self.client.get("/users/autocomplete?q=warb")
+
+        self.assertEqual(
+            [u["username"] for u in response.json["users"]],
+            ["Warbler", "warbling"])
+
+    def test_warm_up(self):
+        user_search.usernames = None
+
+        warm_up()
+
+        self.assertEqual(len(user_search.usernames), 3)
+
+    def test_autocomplete_follows_profile_edits(self):
+        with self.client.session_transaction() as session:
+            session["curr_user"] = self.u1_id
+
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            self.client.post("/users/profile", data={
+                "username": "crowbar",
+                "password": "password",
+            })
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+        response = self.client.get("/users/autocomplete?q=crow")
+
+        self.assertEqual(
+            [u["username"] for u in response.json["users"]],
+            ["crow", "crowbar"])
+
+    def test_autocomplete_requires_login(self):
+        response = self.client.get("/users/autocomplete?q=warb")
+
+        self.assertEqual(response.status_code, 401)
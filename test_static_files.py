@@ -0,0 +1,105 @@
+"""Static file middleware tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_static_files.py
+
+
+import gzip
+import os
+from unittest import TestCase
+
+from models import db
+from query_stats import recorded_queries
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, static_files
+
+db.create_all()
+
+app.config['TESTING'] = True
+
+
+class StaticFilesTestCase(TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+        with open('static/stylesheets/style.css', 'rb') as f:
+            self.css = f.read()
+
+    def test_plain_url(self):
+        response = self.client.get("/static/stylesheets/style.css")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), self.css)
+        self.assertEqual(
+            response.headers["Content-Type"], "text/css; charset=utf-8")
+        self.assertEqual(
+            response.headers["Cache-Control"], "public, max-age=3600")
+        self.assertNotIn("Set-Cookie", response.headers)
+
+    def test_fingerprinted_url_is_immutable(self):
+        url = static_files.url("stylesheets/style.css")
+        self.assertRegex(url, r"^/static/stylesheets/style\.\w{12}\.css$")
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.get_data(), self.css)
+        self.assertIn("immutable", response.headers["Cache-Control"])
+
+    def test_gzip(self):
+        response = self.client.get(
+            "/static/stylesheets/style.css",
+            headers={"Accept-Encoding": "gzip, deflate"})
+
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(gzip.decompress(response.get_data()), self.css)
+
+        # Already-compressed formats are served as they are.
+        response = self.client.get(
+            "/static/images/warbler-logo.png",
+            headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_conditional_get(self):
+        etag = self.client.get("/static/favicon.ico").headers["ETag"]
+
+        response = self.client.get(
+            "/static/favicon.ico", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_head_and_methods(self):
+        response = self.client.head("/static/stylesheets/style.css")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), b"")
+
+        response = self.client.post("/static/stylesheets/style.css")
+        self.assertEqual(response.status_code, 405)
+
+    def test_never_touches_the_database(self):
+        with recorded_queries() as queries:
+            with self.client.session_transaction() as session:
+                session["curr_user"] = 1
+            self.client.get("/static/images/default-pic.png")
+
+        self.assertEqual(queries, [])
+
+    def test_unknown_files_fall_through(self):
+        response = self.client.get("/static/nope.css")
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_templates_use_fingerprinted_urls(self):
+        html = self.client.get("/login").get_data(as_text=True)
+
+        self.assertIn(static_files.url("stylesheets/style.css"), html)
@@ -0,0 +1,185 @@
+"""Login throttling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_throttle.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+from query_stats import recorded_queries
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, login_throttle
+from throttle import LoginThrottle, MemoryStore, SharedStore, ThrottleManager
+
+db.create_all()
+
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LoginThrottleTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.throttle = LoginThrottle(
+            MemoryStore(), username_burst=3, username_per_minute=6,
+            username_free_failures=2, ip_burst=5, ip_per_minute=60,
+            ip_free_failures=100, clock=self.clock)
+
+    def test_username_bucket(self):
+        for _ in range(3):
+            self.assertEqual(self.throttle.allow("u1", "1.1.1.1"), 0)
+
+        # One token comes back every 10 seconds.
+        self.assertEqual(self.throttle.allow("u1", "1.1.1.1"), 10)
+        self.assertEqual(self.throttle.allow("U1", "2.2.2.2"), 10)
+        self.assertEqual(self.throttle.allow("u2", "1.1.1.1"), 0)
+
+        self.clock.now += 10
+        self.assertEqual(self.throttle.allow("u1", "1.1.1.1"), 0)
+
+        self.assertEqual(self.throttle.stats(), {
+            "allowed": 5,
+            "rejected_by_username": 2,
+            "rejected_by_ip": 0,
+            "failed": 0,
+        })
+
+    def test_ip_bucket(self):
+        for n in range(5):
+            self.assertEqual(self.throttle.allow(f"u{n}", "1.1.1.1"), 0)
+
+        self.assertEqual(self.throttle.allow("u9", "1.1.1.1"), 1)
+        self.assertEqual(self.throttle.allow("u9", "2.2.2.2"), 0)
+        self.assertEqual(self.throttle.stats()["rejected_by_ip"], 1)
+
+    def test_failures_back_off_exponentially(self):
+        waits = []
+        for _ in range(5):
+            self.clock.now += 60
+            self.assertEqual(self.throttle.allow("u1", "1.1.1.1"), 0)
+            self.throttle.failed("u1", "1.1.1.1")
+            waits.append(self.throttle.allow("u1", "1.1.1.2"))
+
+        # Two free failures, then 1, 2, 4 seconds of lockout.
+        self.assertEqual(waits, [0, 0, 1, 2, 4])
+
+    def test_success_forgets_failures(self):
+        for _ in range(3):
+            self.clock.now += 60
+            self.throttle.allow("u1", "1.1.1.1")
+            self.throttle.failed("u1", "1.1.1.1")
+
+        self.clock.now += 60
+        self.throttle.allow("u1", "1.1.1.1")
+        self.throttle.succeeded("u1", "1.1.1.1")
+
+        self.throttle.allow("u1", "1.1.1.1")
+        self.throttle.failed("u1", "1.1.1.1")
+        self.assertEqual(self.throttle.allow("u1", "1.1.1.1"), 0)
+
+
+class StoreTestCase(TestCase):
+    def test_memory_store_expiry_and_bound(self):
+        store = MemoryStore(max_entries=2)
+        store.set("a", 1, expires=10)
+        store.set("b", 2, expires=10)
+        store.set("c", 3, expires=20)
+
+        self.assertIsNone(store.get("a", now=0))
+        self.assertEqual(store.get("b", now=0), 2)
+        self.assertIsNone(store.get("b", now=10))
+        self.assertEqual(store.get("c", now=10), 3)
+
+    def test_shared_store(self):
+        """Throttles in different processes see the same state."""
+
+        manager = ThrottleManager(address=('127.0.0.1', 0), authkey=b'test')
+        manager.start()
+        self.addCleanup(manager.shutdown)
+
+        throttles = [
+            LoginThrottle(SharedStore(manager.address, b'test'),
+                          username_burst=2)
+            for _ in range(2)
+        ]
+
+        self.assertEqual(throttles[0].allow("u1", "1.1.1.1"), 0)
+        self.assertEqual(throttles[1].allow("u1", "1.1.1.1"), 0)
+        self.assertGreater(throttles[0].allow("u1", "1.1.1.1"), 0)
+
+
+class ThrottledLoginViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        login_throttle.store.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        login_throttle.store.clear()
+        db.session.rollback()
+
+    def login(self, password):
+        return self.client.post(
+            '/login', data={'username': 'u1', 'password': password})
+
+    def test_rejected_before_any_query(self):
+        # The fourth failure in a row locks the username out.
+        for _ in range(4):
+            self.assertEqual(self.login("not-my-password").status_code, 200)
+
+        with recorded_queries() as queries:
+            resp = self.login("password")
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn('Retry-After', resp.headers)
+        self.assertIn("Too many attempts", resp.get_data(as_text=True))
+        self.assertEqual(queries, [])
+
+    def test_success_resets_backoff(self):
+        self.login("not-my-password")
+        self.assertEqual(self.login("password").status_code, 302)
+        self.assertEqual(self.login("password").status_code, 302)
+
+    def test_ip_bucket_per_forwarded_client(self):
+        """Behind the proxy, each client gets its own IP bucket, not the
+        proxy's."""
+
+        limits = login_throttle.limits['ip']
+        self.addCleanup(login_throttle.limits.__setitem__, 'ip', limits)
+        login_throttle.limits['ip'] = (2, 1 / 3600, limits[2])
+
+        def login_from(client_ip, username):
+            return self.client.post(
+                '/login',
+                data={'username': username, 'password': 'not-my-password'},
+                headers={'X-Forwarded-For': client_ip})
+
+        self.assertEqual(login_from("1.1.1.1", "a1").status_code, 200)
+        self.assertEqual(login_from("1.1.1.1", "a2").status_code, 200)
+        self.assertEqual(login_from("1.1.1.1", "a3").status_code, 429)
+
+        self.assertEqual(login_from("2.2.2.2", "b1").status_code, 200)
@@ -0,0 +1,105 @@
+"""Hybrid timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app (only for its side effect: it connects `db`)
+
+from app import app  # noqa: F401
+from timeline import HybridTimeline
+
+db.create_all()
+
+
+class HybridTimelineTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        star = User.signup("star", "star@email.com", "password", None)
+        fan = User.signup("fan", "fan@email.com", "password", None)
+        pal = User.signup("pal", "pal@email.com", "password", None)
+        fan.following.extend([star, pal])
+        db.session.commit()
+        User.recount()
+        db.session.commit()
+
+        self.star_id = star.id
+        self.fan_id = fan.id
+        self.pal_id = pal.id
+
+        # star and pal each have one real follower; give star a second one
+        # on paper so it is over the threshold and pal is not.
+        User.bump([self.star_id], followers_count=1)
+        db.session.commit()
+        self.timeline = HybridTimeline(celebrity_threshold=2)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def publish(self, user_id, text):
+        msg = Message(text=text, user=User.query.get(user_id))
+        db.session.add(msg)
+        db.session.flush()
+        self.timeline.publish(msg)
+        db.session.commit()
+        return msg
+
+    def test_popular_author_is_pulled_not_pushed(self):
+        msg = self.publish(self.star_id, "from star")
+
+        self.assertEqual(TimelineEntry.messages_for(self.fan_id), [])
+        self.assertEqual(TimelineEntry.messages_for(self.star_id), [msg])
+        self.assertEqual(self.timeline.page(self.fan_id), [msg])
+
+    def test_merge_is_ordered_and_paged(self):
+        m1 = self.publish(self.star_id, "one")
+        m2 = self.publish(self.pal_id, "two")
+        m3 = self.publish(self.star_id, "three")
+
+        self.assertEqual(TimelineEntry.messages_for(self.fan_id), [m2])
+        self.assertEqual(self.timeline.page(self.fan_id), [m3, m2, m1])
+
+        first = self.timeline.page(self.fan_id, limit=2)
+        self.assertEqual(first, [m3, m2])
+        cursor = (first[-1].timestamp, first[-1].id)
+        self.assertEqual(
+            self.timeline.page(self.fan_id, limit=2, before=cursor), [m1])
+
+    def test_message_pushed_before_becoming_popular_is_not_duplicated(self):
+        self.timeline.celebrity_threshold = None
+        msg = self.publish(self.star_id, "early")
+        self.timeline.celebrity_threshold = 2
+
+        self.assertEqual(self.timeline.page(self.fan_id), [msg])
+
+    def test_follow_popular_author_skips_backfill(self):
+        self.publish(self.star_id, "from star")
+        newcomer = User.signup("new", "new@email.com", "password", None)
+        db.session.commit()
+
+        self.timeline.follow(newcomer.id, User.query.get(self.star_id))
+        newcomer.following.append(User.query.get(self.star_id))
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.messages_for(newcomer.id), [])
+        self.assertEqual(len(self.timeline.page(newcomer.id)), 1)
+
+    def test_no_threshold_is_pure_push(self):
+        self.timeline.celebrity_threshold = None
+        msg = self.publish(self.star_id, "from star")
+
+        self.assertEqual(TimelineEntry.messages_for(self.fan_id), [msg])
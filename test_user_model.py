@@ -9,7 +9,8 @@
 import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, password_hasher
+from password_hashing import hash_password, hash_rounds
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +22,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app
+from query_stats import recorded_queries
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -77,6 +79,33 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u1.is_followed_by(u2),False)
         self.assertEqual(u2.is_followed_by(u1),True)
 
+    def test_is_following_uses_one_query_and_memo(self):
+        db.session.add(Follows(
+            user_being_followed_id=self.u2_id,
+            user_following_id=self.u1_id))
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        with recorded_queries() as queries:
+            self.assertTrue(u1.is_following(u2))
+            self.assertTrue(u1.is_following(u2))
+            self.assertTrue(u2.is_followed_by(u1))
+
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('following', vars(u1))
+
+    def test_is_following_memo_forgets_changes(self):
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertFalse(u1.is_following(u2))
+        u1.following.append(u2)
+        self.assertTrue(u1.is_following(u2))
+        u1.following.remove(u2)
+        self.assertFalse(u1.is_following(u2))
+
     def test_user_model_signup_fail(self):
         User.signup("u1", "u1@email.com", "password", None)
 
@@ -92,12 +121,82 @@ class UserModelTestCase(TestCase):
         self.assertEqual(User.authenticate(u1.username, "Wrong_password"), False)
         self.assertEqual(User.authenticate("Wrong_Username", "password"), False)
 
+    def test_user_model_authenticate_rehashes(self):
+        """A hash at an old cost factor is upgraded on successful login."""
+
+        u1 = User.query.get(self.u1_id)
+        u1.password = hash_password("password", 4)
+        db.session.commit()
+
+        self.assertEqual(
+            User.authenticate(u1.username, "Wrong_password"), False)
+        self.assertEqual(hash_rounds(u1.password), 4)
+
+        self.assertEqual(User.authenticate(u1.username, "password"), u1)
+        db.session.commit()
+
+        self.assertEqual(hash_rounds(u1.password), password_hasher.rounds)
+        self.assertEqual(User.authenticate(u1.username, "password"), u1)
 
+    def test_user_model_liked_ids_among(self):
+        u1 = User.query.get(self.u1_id)
+        m1 = Message(text="m1", user_id=self.u2_id)
+        m2 = Message(text="m2", user_id=self.u2_id)
+        db.session.add_all([m1, m2])
+        u1.liked_messages.append(m1)
+        db.session.commit()
 
+        self.assertEqual(u1.liked_ids_among([m1, m2]), {m1.id})
+        self.assertEqual(u1.liked_ids_among([m2]), set())
+        self.assertEqual(u1.liked_ids_among([]), set())
 
+    def test_user_model_bump(self):
+        User.bump([self.u1_id, self.u2_id], followers_count=2, likes_count=1)
+        User.bump([self.u1_id], followers_count=-1)
+        db.session.commit()
 
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual((u1.followers_count, u1.likes_count), (1, 1))
+        self.assertEqual((u2.followers_count, u2.likes_count), (2, 1))
 
+    def test_user_model_recount(self):
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u1.following.append(u2)
+        msg = Message(text="m", user_id=self.u2_id)
+        u1.liked_messages.append(msg)
+        User.bump([self.u2_id], messages_count=5)
+        db.session.commit()
 
+        User.recount()
+        db.session.commit()
 
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual(
+            (u1.messages_count, u1.following_count,
+             u1.followers_count, u1.likes_count),
+            (0, 1, 0, 1))
+        self.assertEqual(
+            (u2.messages_count, u2.following_count,
+             u2.followers_count, u2.likes_count),
+            (1, 0, 1, 0))
+
+    def test_user_model_release_counts(self):
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u1.following.append(u2)
+        u2.following.append(u1)
+        u1.liked_messages.append(Message(text="m", user_id=self.u2_id))
+        db.session.commit()
+        User.recount()
+        db.session.commit()
 
+        u2.release_counts()
+        db.session.commit()
 
+        u1 = User.query.get(self.u1_id)
+        self.assertEqual(
+            (u1.following_count, u1.followers_count, u1.likes_count),
+            (0, 0, 0))
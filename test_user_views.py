@@ -1,9 +1,10 @@
 from unittest import TestCase
 
 import os
+import time
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, password_hasher
 #from http import client
 
 # BEFORE we import our app, let's set an environmental variable
@@ -15,7 +16,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, do_login
+from flask import session
+from flask_wtf.csrf import generate_csrf
+
+from app import app, do_login, RECENT_AUTH_KEY
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -87,6 +91,277 @@ class UserViewsAppTestCase(TestCase):
             response = client.get('/messages/new')
             self.assertEqual(response.status_code, 200)
 
+    def test_follow_updates_counts(self):
+        with self.client as client:
+            with client.session_transaction() as session:
+                session["curr_user"] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+
+            client.post(f"/users/stop-following/{self.u2_id}")
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+
+    def test_show_user_conditional_get(self):
+        with self.client as client:
+            with client.session_transaction() as session:
+                session["curr_user"] = self.u1_id
+
+            response = client.get(f"/users/{self.u2_id}")
+            etag = response.headers["ETag"]
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("no-cache", response.headers["Cache-Control"])
+
+            response = client.get(
+                f"/users/{self.u2_id}", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b"")
+
+            # Following changes both users' versions, so the page is stale.
+            client.post(f"/users/follow/{self.u2_id}")
+            response = client.get(
+                f"/users/{self.u2_id}", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_follow_list_etag_tracks_listed_users(self):
+        u1 = User.query.get(self.u1_id)
+        u1.following.append(User.query.get(self.u2_id))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session["curr_user"] = self.u1_id
+
+            etag = client.get(f"/users/{self.u1_id}/following").headers["ETag"]
+
+            User.bump([self.u2_id])
+            db.session.commit()
+
+            response = client.get(
+                f"/users/{self.u1_id}/following",
+                headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+
+    def test_uncached_pages_are_no_store(self):
+        response = self.client.get("/login")
+
+        self.assertIn("no-store", response.headers["Cache-Control"])
+
+    def test_user_directory_pages(self):
+        page_size = app.config['USERS_PAGE_SIZE']
+        app.config['USERS_PAGE_SIZE'] = 1
+
+        try:
+            with self.client.session_transaction() as session:
+                session["curr_user"] = self.u1_id
+
+            response = self.client.get("/users")
+            self.assertTrue(response.is_streamed)
+
+            html = response.get_data(as_text=True)
+            self.assertIn("@u1", html)
+            self.assertNotIn("@u2", html)
+            self.assertIn("/users?after=u1", html)
+
+            response = self.client.get("/users?after=u1")
+            html = response.get_data(as_text=True)
+
+            self.assertIn("@u2", html)
+            self.assertNotIn("@u1<", html)
+            self.assertNotIn("More users", html)
+        finally:
+            app.config['USERS_PAGE_SIZE'] = page_size
+
+    def test_user_directory_follow_state(self):
+        db.session.add(Follows(
+            user_being_followed_id=self.u2_id,
+            user_following_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session["curr_user"] = self.u1_id
+
+            html = client.get("/users").get_data(as_text=True)
+
+            self.assertIn(f"/users/stop-following/{self.u2_id}", html)
+            self.assertIn(f"/users/follow/{self.u1_id}", html)
+
+    def test_user_directory_consumes_flashes(self):
+        with self.client as client:
+            with client.session_transaction() as session:
+                session["curr_user"] = self.u1_id
+                session["_flashes"] = [("success", "Hello there")]
+
+            html = client.get("/users").get_data(as_text=True)
+            self.assertIn("Hello there", html)
+
+            html = client.get("/users").get_data(as_text=True)
+            self.assertNotIn("Hello there", html)
+
+    def test_follow_pages_are_paginated(self):
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        u3_id = u3.id
+
+        for follower_id in (self.u1_id, u3_id):
+            db.session.add(Follows(
+                user_being_followed_id=self.u2_id,
+                user_following_id=follower_id))
+        db.session.commit()
+
+        page_size = app.config['USERS_PAGE_SIZE']
+        app.config['USERS_PAGE_SIZE'] = 1
+
+        try:
+            with self.client as client:
+                with client.session_transaction() as session:
+                    session["curr_user"] = self.u1_id
+
+                html = client.get(
+                    f"/users/{self.u2_id}/followers").get_data(as_text=True)
+                self.assertIn("@u1", html)
+                self.assertNotIn("@u3", html)
+                self.assertIn(
+                    f"/users/{self.u2_id}/followers?after={self.u1_id}", html)
+
+                html = client.get(
+                    f"/users/{self.u2_id}/followers?after={self.u1_id}"
+                ).get_data(as_text=True)
+                self.assertIn("@u3", html)
+                self.assertIn(f"/users/follow/{u3_id}", html)
+                self.assertNotIn("?after=", html)
+
+                response = client.get(
+                    f"/users/{self.u2_id}/followers?after=nope")
+                self.assertEqual(response.status_code, 400)
+        finally:
+            app.config['USERS_PAGE_SIZE'] = page_size
+
+    def test_following_page_follow_state(self):
+        db.session.add(Follows(
+            user_being_followed_id=self.u2_id,
+            user_following_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session["curr_user"] = self.u1_id
+
+            html = client.get(
+                f"/users/{self.u1_id}/following").get_data(as_text=True)
+
+            self.assertIn("@u2", html)
+            self.assertIn(f"/users/stop-following/{self.u2_id}", html)
+
+    def test_csrf_token_only_made_for_forms(self):
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            with self.client as client:
+                client.get("/")
+                self.assertNotIn("csrf_token", session)
+
+                with client.session_transaction() as sess:
+                    sess["curr_user"] = self.u1_id
+
+                # The logged-in nav bar has the logout form.
+                client.get("/")
+                self.assertIn("csrf_token", session)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+    def test_logout_checks_csrf_token(self):
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            with self.client as client:
+                with client.session_transaction() as sess:
+                    sess["curr_user"] = self.u1_id
+
+                client.post("/logout", data={"csrf_token": "forged"})
+                self.assertIn("curr_user", session)
+
+                client.get("/")
+                client.post(
+                    "/logout", data={"csrf_token": generate_csrf()})
+                self.assertNotIn("curr_user", session)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+    def test_profile_edit_after_recent_login(self):
+        """A password entered moments ago isn't asked for (or hashed) again."""
+
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        try:
+            with self.client.session_transaction() as sess:
+                sess["curr_user"] = self.u1_id
+                sess[RECENT_AUTH_KEY] = time.time()
+
+            html = self.client.get("/users/profile").get_data(as_text=True)
+            self.assertNotIn("enter your password", html)
+
+            checks = password_hasher.stats()["completed"]
+            resp = self.client.post(
+                "/users/profile", data={"bio": "Fresh bio"})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(password_hasher.stats()["completed"], checks)
+            self.assertEqual(User.query.get(self.u1_id).bio, "Fresh bio")
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+    def test_profile_edit_needs_password_once_stale(self):
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = False
+        stale = time.time() - app.config['RECENT_AUTH_SECONDS'] - 1
+
+        try:
+            with self.client as client:
+                with client.session_transaction() as sess:
+                    sess["curr_user"] = self.u1_id
+                    sess[RECENT_AUTH_KEY] = stale
+
+                client.post("/users/profile", data={"bio": "No password"})
+                self.assertIsNone(User.query.get(self.u1_id).bio)
+
+                client.post("/users/profile", data={
+                    "bio": "With password", "password": "password"})
+                self.assertEqual(
+                    User.query.get(self.u1_id).bio, "With password")
+                self.assertGreater(session[RECENT_AUTH_KEY], stale)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+    def test_delete_user_needs_recent_login(self):
+        csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        try:
+            with self.client.session_transaction() as sess:
+                sess["curr_user"] = self.u1_id
 
+            resp = self.client.post("/users/delete")
+            self.assertEqual(resp.location, "/login")
+            self.assertIsNotNone(User.query.get(self.u1_id))
 
+            with self.client.session_transaction() as sess:
+                sess[RECENT_AUTH_KEY] = time.time()
 
+            resp = self.client.post("/users/delete")
+            self.assertEqual(resp.location, "/signup")
+            db.session.expire_all()
+            self.assertIsNone(User.query.get(self.u1_id))
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = csrf_enabled
@@ -0,0 +1,275 @@
+"""Login throttling, checked before any database lookup or bcrypt work.
+
+Every password check (login, and the password re-entry on profile edits)
+first asks `LoginThrottle.allow` for admission. Attempts are metered by
+two token buckets, one per username and one per client IP, and each
+failed attempt past a few free ones locks its username and IP out for
+exponentially longer (1s, 2s, 4s, ... up to `max_backoff`). A rejected
+attempt costs a couple of dictionary lookups instead of a query and a
+full bcrypt verification.
+
+Throttle state lives in a store:
+
+- `MemoryStore` keeps it in the web process, so each process throttles
+  on its own (limits are effectively multiplied by the process count);
+- `SharedStore` keeps it in a separate server process that every web
+  process connects to, standing in for a shared cache like memcached or
+  Redis. Run one with `flask throttle-store`.
+"""
+
+import math
+import os
+import time
+from collections import OrderedDict
+from multiprocessing.managers import AcquirerProxy, BaseManager, DictProxy
+from threading import Lock
+
+
+class MemoryStore:
+    """In-process store of expiring values, LRU-bounded to `max_entries`."""
+
+    def __init__(self, max_entries=100_000):
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lock(self):
+        """Return the lock that makes a get-then-set atomic."""
+
+        return self._lock
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            return None
+
+        return entry[1]
+
+    def set(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_shared_entries = {}
+_shared_lock = Lock()
+
+
+def _get_shared_entries():
+    return _shared_entries
+
+
+def _get_shared_lock():
+    return _shared_lock
+
+
+class ThrottleManager(BaseManager):
+    """Serves one dict of entries, and a lock over it, to every client."""
+
+
+ThrottleManager.register('entries', _get_shared_entries, DictProxy)
+ThrottleManager.register('lock', _get_shared_lock, AcquirerProxy)
+
+
+def serve_shared_store(address, authkey):
+    """Run a `SharedStore` server at `address` until interrupted."""
+
+    manager = ThrottleManager(address=address, authkey=authkey)
+    manager.get_server().serve_forever()
+
+
+class SharedStore:
+    """Store kept in a `serve_shared_store` server process.
+
+    Expired entries are only overwritten, never swept, so the server's
+    memory grows with the number of distinct usernames and IPs seen;
+    restart it now and then.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._manager = None
+        self._pid = None
+
+    def _connect(self):
+        # Connections made before a fork belong to the parent.
+        if self._manager is None or self._pid != os.getpid():
+            manager = ThrottleManager(
+                address=self.address, authkey=self.authkey)
+            manager.connect()
+            self._entries = manager.entries()
+            self._lock = manager.lock()
+            self._manager = manager
+            self._pid = os.getpid()
+
+    def lock(self):
+        self._connect()
+        return self._lock
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            return None
+
+        return entry[1]
+
+    def set(self, key, value, expires):
+        self._entries.update({key: (expires, value)})
+
+    def clear(self):
+        self._connect()
+        with self._lock:
+            self._entries.clear()
+
+
+class LoginThrottle:
+    """Per-username and per-IP admission control for password checks.
+
+    Each attempt takes a token from its username's bucket and its IP's
+    bucket; buckets hold `*_burst` tokens and refill at `*_per_minute`.
+    Beyond the first `*_free_failures` consecutive failures, each failure
+    locks the username (or IP) out for twice as long as the last, up to
+    `max_backoff` seconds. A successful login clears its username's
+    failures.
+    """
+
+    def __init__(self, store=None, username_burst=5, username_per_minute=5,
+                 username_free_failures=3, ip_burst=30, ip_per_minute=30,
+                 ip_free_failures=20, max_backoff=15 * 60, clock=time.time):
+        self.store = store if store is not None else MemoryStore()
+        self.limits = {
+            'username': (username_burst, username_per_minute / 60,
+                         username_free_failures),
+            'ip': (ip_burst, ip_per_minute / 60, ip_free_failures),
+        }
+        self.max_backoff = max_backoff
+        self.clock = clock
+
+        self._lock = Lock()
+        self.reset_stats()
+
+    def allow(self, username, ip):
+        """Admit an attempt, or return whole seconds until one would be.
+
+        Returns 0 when the attempt may go ahead (and spends its tokens).
+        """
+
+        keys = self._keys(username, ip)
+        now = self.clock()
+
+        with self.store.lock():
+            states = {kind: self._state(kind, key, now)
+                      for kind, key in keys.items()}
+            waits = {kind: self._wait(kind, state, now)
+                     for kind, state in states.items()}
+            wait = math.ceil(max(waits.values()))
+
+            if not wait:
+                for kind, key in keys.items():
+                    tokens, blocked_until, failures = states[kind]
+                    self._save(kind, key,
+                               (tokens - 1, blocked_until, failures), now)
+
+        with self._lock:
+            if not wait:
+                self._allowed += 1
+            else:
+                self._rejected[max(waits, key=waits.get)] += 1
+
+        return wait
+
+    def failed(self, username, ip):
+        """Record a wrong password for an admitted attempt."""
+
+        now = self.clock()
+
+        with self.store.lock():
+            for kind, key in self._keys(username, ip).items():
+                tokens, _, failures = self._state(kind, key, now)
+                failures += 1
+                free = self.limits[kind][2]
+                backoff = 0
+                if failures > free:
+                    backoff = min(2 ** (failures - free - 1), self.max_backoff)
+                self._save(kind, key, (tokens, now + backoff, failures), now)
+
+        with self._lock:
+            self._failed += 1
+
+    def succeeded(self, username, ip):
+        """Record a correct password: forget the username's failures."""
+
+        now = self.clock()
+        kind, key = 'username', self._keys(username, ip)['username']
+
+        with self.store.lock():
+            tokens, _, _ = self._state(kind, key, now)
+            self._save(kind, key, (tokens, now, 0), now)
+
+    def stats(self):
+        """Return admission counters, for /_metrics."""
+
+        with self._lock:
+            return {
+                "allowed": self._allowed,
+                "rejected_by_username": self._rejected['username'],
+                "rejected_by_ip": self._rejected['ip'],
+                "failed": self._failed,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._allowed = 0
+            self._rejected = {'username': 0, 'ip': 0}
+            self._failed = 0
+
+    @staticmethod
+    def _keys(username, ip):
+        return {
+            'username': f"throttle:username:{(username or '').lower()}",
+            'ip': f"throttle:ip:{ip}",
+        }
+
+    def _state(self, kind, key, now):
+        """Return (tokens, blocked until, failures), tokens refilled to now."""
+
+        burst, per_second, _ = self.limits[kind]
+        stored = self.store.get(key, now)
+        if stored is None:
+            return (burst, now, 0)
+
+        tokens, updated_at, blocked_until, failures = stored
+        tokens = min(burst, tokens + (now - updated_at) * per_second)
+        return (tokens, blocked_until, failures)
+
+    def _wait(self, kind, state, now):
+        tokens, blocked_until, _ = state
+        per_second = self.limits[kind][1]
+
+        wait = max(0, blocked_until - now)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / per_second)
+        return wait
+
+    def _save(self, kind, key, state, now):
+        tokens, blocked_until, failures = state
+        burst, per_second, _ = self.limits[kind]
+
+        # Nothing worth keeping once the bucket is full and any lockout
+        # is over, though failures count on until then.
+        expires = max(now + (burst - tokens) / per_second, blocked_until)
+        if failures:
+            expires = max(expires, now + self.max_backoff)
+
+        self.store.set(
+            key, (tokens, now, blocked_until, failures), expires)
@@ -0,0 +1,97 @@
+"""Hybrid push/pull home timelines."""
+
+from sqlalchemy import select, tuple_
+
+from models import Follows, Message, TimelineEntry, User
+
+
+class HybridTimeline:
+    """Home timelines that push for most authors and pull for popular ones.
+
+    Messages by ordinary authors are fanned out on write into each
+    follower's timeline_entries inbox, so reads are one indexed lookup.
+    Fanning out for an account with a huge following would make every post
+    a huge write, so authors with at least `celebrity_threshold` followers
+    only write to their own inbox. Readers pull the recent messages of the
+    popular accounts they follow at read time and merge them in.
+
+    With `celebrity_threshold=None` nothing is pulled (pure fan-out).
+
+    Messages posted while an author was over the threshold are not in
+    follower inboxes, so if the author later drops below it those messages
+    are missing until `flask rebuild-timelines` is run.
+    """
+
+    def __init__(self, celebrity_threshold=None):
+        self.celebrity_threshold = celebrity_threshold
+
+    def is_celebrity(self, user):
+        """Are `user`'s messages pulled by readers rather than pushed?"""
+
+        return (self.celebrity_threshold is not None
+                and user.followers_count >= self.celebrity_threshold)
+
+    def publish(self, message):
+        """Deliver a newly flushed message."""
+
+        TimelineEntry.fan_out(
+            message, to_followers=not self.is_celebrity(message.user))
+
+    def follow(self, owner_id, author):
+        """`owner_id` started following `author`."""
+
+        if not self.is_celebrity(author):
+            TimelineEntry.backfill(owner_id, author.id)
+
+    def unfollow(self, owner_id, author):
+        """`owner_id` stopped following `author`."""
+
+        # Pruned even for popular authors, whose older messages may have
+        # been pushed before they crossed the threshold.
+        TimelineEntry.prune(owner_id, author.id)
+
+    def page(self, owner_id, limit=100, before=None):
+        """Return a page of `owner_id`'s home timeline, newest first.
+
+        `before` is a (timestamp, message id) keyset cursor, as for
+        `TimelineEntry.messages_for`.
+        """
+
+        pushed = TimelineEntry.messages_for(
+            owner_id, limit=limit, before=before)
+
+        if self.celebrity_threshold is None:
+            return pushed
+
+        pulled = self.pulled(owner_id, limit=limit, before=before)
+        if not pulled:
+            return pushed
+
+        # A message can be in both lists if its author crossed the
+        # threshold after it was pushed.
+        merged = {msg.id: msg for msg in pushed + pulled}.values()
+
+        return sorted(
+            merged,
+            key=lambda msg: (msg.timestamp, msg.id),
+            reverse=True)[:limit]
+
+    def pulled(self, owner_id, limit=100, before=None):
+        """Recent messages by popular accounts that `owner_id` follows."""
+
+        popular_ids = (
+            select(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .where(Follows.user_following_id == owner_id)
+            .where(User.followers_count >= self.celebrity_threshold))
+
+        query = Message.with_authors().filter(Message.user_id.in_(popular_ids))
+
+        if before:
+            query = query.filter(
+                tuple_(Message.timestamp, Message.id) < tuple_(*before))
+
+        return (query
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(limit)
+                .all())